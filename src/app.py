@@ -9,6 +9,7 @@
 
 # ------- Libraries, utils, and modules -------
 import os
+import click
 import bleach
 import jinja2
 import werkzeug
@@ -20,12 +21,22 @@ from flask_babel import get_locale
 from init import app, cache, db, log, debug_log, socketio
 from modules.database import Agent, AnnouncementMessage, RedirectRule, database, PhoneNumber, user_datastore
 from modules.admin import admin_pages
-from modules.messaging import messaging
+from modules.messaging import messaging, emit_sidebar_update
 from modules.dev_panel import dev_pages
 from modules.multiserver import multi_server
 from utils.email import SecurityMailUtil
 from utils.global_helpers import validate_e164_phone_num, get_cid_phone_num, get_phone_num_cid, get_display_name_cid
 from utils.google_analytics import Analytics
+from utils.inbound_queue import inbound_queue
+from utils.sid_filter import sid_filter
+from utils.media_downloads import media_downloader
+from utils.outbound_dispatcher import outbound_dispatcher
+from utils.routing_table import routing_table
+from utils.unread_counter import unread_counter
+from utils.query_plans import check_query_plans, QueryPlanError
+from utils.cross_bind import non_agent_filter
+from utils.access_control import access_control
+from utils.announcements import announcement_cache
 from msg_dsp_text import UI_ELEMENTS_TEXT, FLASH_MESSAGES
 from datetime import datetime, timedelta
 from utils.forms import AdminNewRedirectRuleForm, AdminChangeDisplayNameForm
@@ -178,57 +189,12 @@ def update_userset_settings():
         AppConfig.update_user_settings()
         
         
-@app.before_request
-def clear_announcement_messages():
-    msgs = AnnouncementMessage.query.all()
-    
-    for msg in msgs:
-        if msg.duration != "inf":
-            msg_dur_mx = msg.duration.split("-")[1]
-            msg_dur_num = int(msg.duration.split("-")[0])
-            tdelta = None
-            
-            if msg_dur_mx == "mt":
-                tdelta = msg.start_time + timedelta(minutes=msg_dur_num)
-            
-            elif msg_dur_mx == "hr":
-                tdelta = msg.start_time + timedelta(hours=msg_dur_num)
-                
-            elif msg_dur_mx == "wk":
-                tdelta = msg.start_time + timedelta(weeks=msg_dur_num)
-            
-            if tdelta and tdelta <= datetime.now():
-                debug_log.debug(f"Clearing announcement message as [{msg.duration}] duration is over. [{msg.id}: {msg.message}]")
-                db.session.delete(msg)
-            
-    db.session.commit()
-
-
 # ------- Page routes -------
 @app.route("/")
 @auth_required("session")
 def index():
-    user_id = current_user.id 
-    agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-    redirect_rules = []
-    
-    if agent:
-        redirect_rules = db.session.query(RedirectRule).filter_by(agent_id=agent.id).all()
-    
-    phone_nums = []
-        
-    if current_user.has_role("admin"):
-        phones = PhoneNumber.query.all()
-        
-        for num in phones:
-            phone_nums.append(num.number)
-            
-    else:
-        for rule in redirect_rules:
-            phone_nums.append(rule.phone_number)
-                
-    announcement_messages = AnnouncementMessage.query.all()
-    return render_template("index.html", phone_number="NO_CHAT_PAGE", phone_nums=phone_nums, customer_id="NO_CHAT_PAGE", announcement_messages=announcement_messages)
+    announcement_messages = announcement_cache.active()
+    return render_template("index.html", phone_number="NO_CHAT_PAGE", customer_id="NO_CHAT_PAGE", announcement_messages=announcement_messages)
 
 
 @app.route("/msgs/<customer_id>", methods=["POST", "GET"])
@@ -244,9 +210,8 @@ def index_msgs(customer_id):
     for agent in Agent.query.all():
         agents.append((agent.id, agent.name))
             
-    for number in PhoneNumber.query.all():
-        if not Agent.query.filter_by(phone_number=number.number).first():    
-            phone_numbers.append((number.number, number.customer_id))
+    for number in db.session.query(PhoneNumber.number, PhoneNumber.customer_id).filter(non_agent_filter()).all():
+        phone_numbers.append((number.number, number.customer_id))
     
     form.redirect_to_agent.choices = agents
     form.redirect_phone_number.choices = phone_numbers
@@ -264,6 +229,7 @@ def index_msgs(customer_id):
                     if not customer_new:
                         customer.display_name = form2.new_display_name.data.lower()
                         db.session.commit()
+                        emit_sidebar_update(customer.number)
                         
                         flash(FLASH_MESSAGES.RENAME_CUSTOMER_SUCCESS, "success")
                         return form_return
@@ -296,6 +262,7 @@ def index_msgs(customer_id):
                     if not agents_db:
                         db.session.add(redirect_rule)
                         db.session.commit()
+                        routing_table.invalidate()
                         debug_log.debug(f"Added new redirect rule: {[form.redirect_rule_name.data, form.redirect_phone_number.data, form.redirect_to_agent.data]}")
                         
                         flash(FLASH_MESSAGES.ADD_REDIRECT_RULE_SUCCESS, "success")
@@ -313,35 +280,9 @@ def index_msgs(customer_id):
         abort(401)
     
     if phone_number:
-        user_id = current_user.id 
-        agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-        redirect_rules = []
-    
-        if agent:
-            redirect_rules = db.session.query(RedirectRule).filter_by(agent_id=agent.id).all()
-        
-        rule_avail = False
-        phone_nums = []
-        
-        if current_user.has_role("admin"):
-            phones = PhoneNumber.query.all()
-            
-            for num in phones:
-                phone_nums.append(num.number)
-        
-        for rule in redirect_rules:
-            if agent and rule.agent_id == agent.id:
-                if not current_user.has_role("admin"):
-                    phone_nums.append(rule.phone_number)
-                    
-                rule_avail = True
-                
-        if rule_avail or current_user.has_role("admin"):
-            pn_database = PhoneNumber.query.filter_by(number=phone_number).first()
-            
-            if pn_database:
-                pn_database.unread_msgs = 0
-                db.session.commit()
+        if access_control.can_access(current_user, phone_number):
+            if unread_counter.reset(phone_number):
+                emit_sidebar_update(phone_number)
                 
             form.redirect_phone_number.default = phone_number
             form.process()
@@ -350,8 +291,8 @@ def index_msgs(customer_id):
             form2.process()
             
             redirect_rules = RedirectRule.query.filter_by(phone_number=phone_number).all()
-            announcement_messages = AnnouncementMessage.query.all()
-            return render_template("index.html", phone_number=phone_number, phone_nums=phone_nums, form=form, form2=form2, customer_id=customer_id, redirect_rules=redirect_rules, display_name=get_display_name_cid(customer_id), announcement_messages=announcement_messages)
+            announcement_messages = announcement_cache.active()
+            return render_template("index.html", phone_number=phone_number, form=form, form2=form2, customer_id=customer_id, redirect_rules=redirect_rules, display_name=get_display_name_cid(customer_id), announcement_messages=announcement_messages)
     
     debug_log.debug(f"[{request.remote_addr}] Attempted to open chat page for a number that is not in their redirects list. [{phone_number}]")
     abort(404)
@@ -363,25 +304,9 @@ def index_msgs_set_read(customer_id):
     phone_number = get_phone_num_cid(bleach.clean(customer_id))
     
     if phone_number:
-        user_id = current_user.id 
-        agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-        redirect_rules = []
-    
-        if agent:
-            redirect_rules = db.session.query(RedirectRule).filter_by(agent_id=agent.id).all()
-        
-        rule_avail = False
-        
-        for rule in redirect_rules:
-            if agent and rule.agent_id == agent.id:
-                rule_avail = True
-                
-        if rule_avail or current_user.has_role("admin"):
-            pn_database = PhoneNumber.query.filter_by(number=phone_number).first()
-            
-            if pn_database:
-                pn_database.unread_msgs = 0
-                db.session.commit()
+        if access_control.can_access(current_user, phone_number):
+            if unread_counter.reset(phone_number):
+                emit_sidebar_update(phone_number)
             
             return "OK", 200
     
@@ -403,6 +328,7 @@ def delete_all_redirects_customer(customer_id):
             db.session.delete(rule)
 
         db.session.commit()
+        routing_table.invalidate()
         
         debug_log.debug(f"Successfully deleted all redirect rules for: [{customer_id}]")
         return redirect(url_for(".index_msgs", customer_id=customer_id))
@@ -410,11 +336,41 @@ def delete_all_redirects_customer(customer_id):
     abort(404)
 
 
+# ------- Background services -------
+def start_background_services():
+    with app.app_context():
+        sid_filter.seed()
+        inbound_queue.start()
+        media_downloader.start()
+        outbound_dispatcher.start()
+        announcement_cache.start()
+
+
+# ------- CLI commands -------
+# ---- "flask --app app check-query-plans", exits with a non-zero status if a hot query has no usable index ----
+# Run by start_server.sh after "flask db upgrade". Missing tables are created first, as on startup.
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    db.create_all()
+    
+    try:
+        check_query_plans()
+    
+    except QueryPlanError as e:
+        raise click.ClickException(str(e))
+    
+    click.echo("All hot queries use an index.")
+
+
 # ------- Running the app -------
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
         
+        if app.debug:
+            check_query_plans()
+        
+    start_background_services()
     socketio.run(app)
 
 # ---- For production ----
@@ -422,4 +378,9 @@ def create_app():
     with app.app_context():
         db.create_all()
         
+        if app.debug:
+            check_query_plans()
+        
+    start_background_services()
+        
     return app
\ No newline at end of file
@@ -51,11 +51,28 @@ class ProductionConfig():
         "messages": "sqlite:///data/database/messages.sqlite3",
         "agents": "sqlite:///data/database/agents.sqlite3"}
     
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {
         "pool_pre_ping": True,
         # "client_encoding": "utf8"
     }
+    
+    # ---- SQLite pragmas applied to every connection, SQLITE_BIND_PROFILES overrides them per bind (None is the main database) ----
+    SQLITE_ENGINE_PROFILE = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,  # In KiB when negative
+        "mmap_size": 128*1024*1024
+    }
+    
+    SQLITE_BIND_PROFILES = {
+        "messages": {"cache_size": -64000}
+    }
+    
+    # ---- Binds ATTACHed (under their bind key) to every connection of another bind, e.g. {"messages": ["agents"]} ----
+    # Lets customer queries join agents and redirect rules in SQL instead of using the routing table.
+    SQLITE_ATTACHED_BINDS = {}
 
     # ------- Flask-Security config -------
     SECURITY_PASSWORD_SALT = os.getenv("PASSWORD_ENCRYPT_SALT")
@@ -86,6 +103,35 @@ class ProductionConfig():
     WAAPI_REQUEST_BASIC_AUTH_USER = USER_CONFIG_FILE.WAAPI_REQUEST_BASIC_AUTH_USER
     WAAPI_REQUEST_BASIC_AUTH_PASS_HASH = USER_CONFIG_FILE.WAAPI_REQUEST_BASIC_AUTH_PASS_HASH
     WAAPI_REQUEST_BASIC_AUTH_PASS = os.getenv("WAAPI_REQUEST_PASSWORD")
+    WAAPI_CALLBACK_AUTH_MODE = "cached"  # kdf, cached, hmac
+    WAAPI_CALLBACK_AUTH_CACHE_SIZE = 32
+    WAAPI_CALLBACK_TOKEN_MAX_AGE_SEC = 14*24*60*60  # Status callbacks (e.g. READ) can come days after the message was sent
+    WAAPI_CALLBACK_TOKEN_MAX_SKEW_SEC = 5*60
+    WAAPI_MEDIA_FETCH_WORKERS = 4
+    WAAPI_MEDIA_MAX_SIZE_MB = 100
+    WAAPI_MEDIA_CONNECT_TIMEOUT_SEC = 5
+    WAAPI_MEDIA_READ_TIMEOUT_SEC = 30
+    WAAPI_MEDIA_FETCH_MAX_ATTEMPTS = 5
+    WAAPI_MEDIA_FETCH_RETRY_BASE_SEC = 2
+
+    # ------- Background worker config -------
+    INBOUND_QUEUE_WORKERS = 4
+    INBOUND_QUEUE_MAX_BATCH_SIZE = 20
+    INBOUND_SID_FILTER_SIZE = 10000
+    INBOUND_CUSTOMER_LIMIT_RETRY_SEC = 5*60  # Messages from new customers wait while MAX_CUSTOMERS_PER_DAY is reached
+    INBOUND_MAX_ATTEMPTS = 5  # A callback result that still fails is dead-lettered (InboundCallback.error)
+    INBOUND_RETRY_BASE_SEC = 2
+    WAAPI_STATUS_COALESCE_WINDOW_SEC = 1.0  # 0 writes every status update immediately
+    WAAPI_UNMATCHED_STATUS_RETRY_SEC = 2  # A status can arrive before the sent message is recorded
+    WAAPI_UNMATCHED_STATUS_TTL_SEC = 120
+    OUTBOUND_QUEUE_WORKERS = 4
+    OUTBOUND_QUEUE_MAX_BATCH_SIZE = 10
+    OUTBOUND_GLOBAL_RATE_PER_SEC = 20
+    OUTBOUND_GLOBAL_BURST = 40
+    OUTBOUND_RECIPIENT_RATE_PER_SEC = 1
+    OUTBOUND_RECIPIENT_BURST = 5
+    OUTBOUND_MAX_ATTEMPTS = 4
+    OUTBOUND_RETRY_BASE_SEC = 1
 
     # ------- Flask-WTF config -------
     WTF_CSRF_CHECK_DEFAULT = False
@@ -112,6 +158,8 @@ class ProductionConfig():
     ANALYTICS_TAG_ID = USER_CONFIG_FILE.ANALYTICS_TAG_ID
     ANALYTICS_PROPERTY_ID = USER_CONFIG_FILE.ANALYTICS_PROPERTY_ID
     TEMPORARY_FILE_DIR = os.path.join(INSTANCE_DIR, "data/temporary")
+    MEDIA_STORE_FOLDER = os.path.join(INSTANCE_DIR, "data/media_store")
+    MEDIA_STORE_CACHE_MAX_AGE = 365*24*60*60
     RENDER_CACHE_TIMEOUT = CACHE_DEFAULT_TIMEOUT
     STATIC_FOLDER_ABS_PATH = os.path.join(WORKING_DIR, "static")
     UPLOAD_FOLDER_STATIC_RELATIVE = "user-uploaded"
@@ -124,6 +172,9 @@ class ProductionConfig():
     MAX_AGENTS_PER_CUSTOMER = USER_CONFIG_FILE.MAX_AGENTS_PER_CUSTOMER
     MAX_CUSTOMERS_PER_DAY = USER_CONFIG_FILE.MAX_CUSTOMERS_PER_DAY
     MULTISERVER_SERVERS_LIST = USER_CONFIG_FILE.MULTISERVER_SERVERS_LIST
+    MESSAGE_PAGE_SIZE = 50
+    MESSAGE_PAGE_SIZE_MAX = 200
+    MESSAGE_CHANGES_WATERMARK_OVERLAP_SEC = 5
     FILE_MSG_TYPE_TABLE = {
         "image": ["jpg", "jpeg", "png"],
         "audio": ["aac", "amr", "mp3", "opus"],
@@ -133,6 +184,7 @@ class ProductionConfig():
     
     # ------- Form configs -------
     ADD_ANNOUNCEMENT_MESSAGE_FORM_LEVEL_OPTS = [("info", "Info"), ("success", "Success"), ("warning", "Warning"), ("danger", "Danger")]
+    ANNOUNCEMENT_SWEEP_INTERVAL_SEC = 60
     ADD_ANNOUNCEMENT_MESSAGE_FORM_DURATION_OPTS = [("inf", "Infinite"), ("30-mt", "30 Minutes"), ("12-hr", "12 Hours"), ("24-hr", "24 Hours"), ("48-hr", "48 Hours"), ("1-wk", "1 Week"), ("2-wk", "2 Weeks")]
     ADD_AGENT_FORM_TYPE_OPTS = [("phone", "WhatsApp Numara Ajanı"), ("fs_user", "Web Arayüz Ajanı")]
     
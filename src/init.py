@@ -11,13 +11,14 @@
 import logging
 import os
 from flask_socketio import SocketIO
-from flask import Flask, request, session
+from flask import Flask, request, session, has_request_context
 from flask_caching import Cache
 from flask_sqlalchemy import SQLAlchemy
 from infobip_channels import WhatsAppChannel
 from flask_babel import Babel
 from flask_wtf.csrf import CSRFProtect
 from flask_migrate import Migrate
+from utils.sqlite_profile import register_sqlite_profile
 from mailjet_rest import Client
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from config import AppConfig
@@ -26,6 +27,10 @@ from config import AppConfig
 # -=-=-= Functions =-=-=-
 # ---- Custom locale selector for Babel ----
 def localeselector():
+    # Background workers (e.g. the inbound callback queue) have no session, system replies use the default language
+    if not has_request_context():
+        return AppConfig.DEFAULT_LANG
+
     lang = session.get("lang")
 
     if lang:
@@ -69,4 +74,11 @@ socketio = SocketIO(app, logger=socketio_log, engineio_logger=socketio_log)
 ga = None
 
 if AppConfig.ENABLE_ANALYTICS:
-    ga = BetaAnalyticsDataClient()
\ No newline at end of file
+    ga = BetaAnalyticsDataClient()
+
+
+# ---- SQLite engine profile (pragmas on connect) for every bind ----
+with app.app_context():
+    for bind_key, engine in db.engines.items():
+        attached = {key: db.engines[key].url.database for key in AppConfig.SQLITE_ATTACHED_BINDS.get(bind_key, []) if db.engines[key].dialect.name == "sqlite"}
+        register_sqlite_profile(engine, bind_key, attached)
\ No newline at end of file
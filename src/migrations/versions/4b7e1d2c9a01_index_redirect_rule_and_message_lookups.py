@@ -0,0 +1,83 @@
+"""Index redirect rule lookups and the message list
+
+Revision ID: 4b7e1d2c9a01
+Revises: 
+Create Date: 2026-10-18 10:02:11.418203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e1d2c9a01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+# Databases created by db.create_all() after this revision already have its schema
+def _has_table(table):
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _columns(table):
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table):
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade_():
+    pass
+
+
+def downgrade_():
+    pass
+
+
+def upgrade_accounts():
+    pass
+
+
+def downgrade_accounts():
+    pass
+
+
+def upgrade_messages():
+    if not _has_table("message"):
+        return
+
+    if "ix_message_client_number_datetime" not in _indexes("message"):
+        op.create_index("ix_message_client_number_datetime", "message", ["client_number", "datetime"], unique=False)
+
+
+def downgrade_messages():
+    op.drop_index("ix_message_client_number_datetime", table_name="message")
+
+
+def upgrade_agents():
+    if not _has_table("redirect_rule"):
+        return
+
+    indexes = _indexes("redirect_rule")
+
+    if "ix_redirect_rule_phone_number" not in indexes:
+        op.create_index("ix_redirect_rule_phone_number", "redirect_rule", ["phone_number"], unique=False)
+
+    if "ix_redirect_rule_agent_id" not in indexes:
+        op.create_index("ix_redirect_rule_agent_id", "redirect_rule", ["agent_id"], unique=False)
+
+
+def downgrade_agents():
+    op.drop_index("ix_redirect_rule_agent_id", table_name="redirect_rule")
+    op.drop_index("ix_redirect_rule_phone_number", table_name="redirect_rule")
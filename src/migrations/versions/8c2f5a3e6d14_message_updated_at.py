@@ -0,0 +1,79 @@
+"""Add message.updated_at for the message changes endpoint
+
+Revision ID: 8c2f5a3e6d14
+Revises: 4b7e1d2c9a01
+Create Date: 2026-10-18 10:04:37.902556
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2f5a3e6d14'
+down_revision = '4b7e1d2c9a01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+# Databases created by db.create_all() after this revision already have its schema
+def _has_table(table):
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _columns(table):
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table):
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade_():
+    pass
+
+
+def downgrade_():
+    pass
+
+
+def upgrade_accounts():
+    pass
+
+
+def downgrade_accounts():
+    pass
+
+
+def upgrade_messages():
+    if not _has_table("message"):
+        return
+
+    if "updated_at" not in _columns("message"):
+        op.add_column("message", sa.Column("updated_at", sa.DateTime(), nullable=True))
+
+    if "ix_message_client_number_updated_at" not in _indexes("message"):
+        op.create_index("ix_message_client_number_updated_at", "message", ["client_number", "updated_at"], unique=False)
+
+
+def downgrade_messages():
+    op.drop_index("ix_message_client_number_updated_at", table_name="message")
+
+    with op.batch_alter_table("message") as batch_op:
+        batch_op.drop_column("updated_at")
+
+
+def upgrade_agents():
+    pass
+
+
+def downgrade_agents():
+    pass
@@ -0,0 +1,79 @@
+"""Add announcement_message.expires_at
+
+Revision ID: d91e7b4a0f25
+Revises: 8c2f5a3e6d14
+Create Date: 2026-10-18 10:06:52.130874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91e7b4a0f25'
+down_revision = '8c2f5a3e6d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+# Databases created by db.create_all() after this revision already have its schema
+def _has_table(table):
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _columns(table):
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _indexes(table):
+    return {index["name"] for index in sa.inspect(op.get_bind()).get_indexes(table)}
+
+
+def upgrade_():
+    if not _has_table("announcement_message"):
+        return
+
+    if "expires_at" not in _columns("announcement_message"):
+        op.add_column("announcement_message", sa.Column("expires_at", sa.DateTime(), nullable=True))
+
+    if "ix_announcement_message_expires_at" not in _indexes("announcement_message"):
+        op.create_index("ix_announcement_message_expires_at", "announcement_message", ["expires_at"], unique=False)
+
+
+def downgrade_():
+    op.drop_index("ix_announcement_message_expires_at", table_name="announcement_message")
+
+    with op.batch_alter_table("announcement_message") as batch_op:
+        batch_op.drop_column("expires_at")
+
+
+def upgrade_accounts():
+    pass
+
+
+def downgrade_accounts():
+    pass
+
+
+def upgrade_messages():
+    pass
+
+
+def downgrade_messages():
+    pass
+
+
+def upgrade_agents():
+    pass
+
+
+def downgrade_agents():
+    pass
@@ -0,0 +1,77 @@
+"""Add inbound_callback.attempts and error for retries and dead letters
+
+Revision ID: e4a8c1f6b392
+Revises: d91e7b4a0f25
+Create Date: 2026-10-18 14:12:37.502916
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a8c1f6b392'
+down_revision = 'd91e7b4a0f25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade(engine_name):
+    globals()["upgrade_%s" % engine_name]()
+
+
+def downgrade(engine_name):
+    globals()["downgrade_%s" % engine_name]()
+
+
+# Databases created by db.create_all() after this revision already have its schema
+def _has_table(table):
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def _columns(table):
+    return {column["name"] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade_():
+    pass
+
+
+def downgrade_():
+    pass
+
+
+def upgrade_accounts():
+    pass
+
+
+def downgrade_accounts():
+    pass
+
+
+def upgrade_messages():
+    if not _has_table("inbound_callback"):
+        return
+
+    columns = _columns("inbound_callback")
+
+    if "attempts" not in columns:
+        op.add_column("inbound_callback", sa.Column("attempts", sa.Integer(), nullable=True))
+        op.execute("UPDATE inbound_callback SET attempts = 0")
+
+    if "error" not in columns:
+        op.add_column("inbound_callback", sa.Column("error", sa.Text(), nullable=True))
+
+
+def downgrade_messages():
+    with op.batch_alter_table("inbound_callback") as batch_op:
+        batch_op.drop_column("error")
+        batch_op.drop_column("attempts")
+
+
+def upgrade_agents():
+    pass
+
+
+def downgrade_agents():
+    pass
@@ -16,6 +16,8 @@ from utils.forms import AdminNewRedirectRuleForm, AdminNewAgentForm
 from msg_dsp_text import FLASH_MESSAGES
 from utils.global_helpers import validate_e164_phone_num
 from modules.database import PhoneNumber, RedirectRule, Agent
+from utils.routing_table import routing_table
+from utils.cross_bind import non_agent_filter
 from init import db, debug_log, app
 from datetime import datetime
 
@@ -45,9 +47,8 @@ def manage_redirects():
     for agent in Agent.query.all():
         agents.append((agent.id, agent.name))
         
-    for number in PhoneNumber.query.all():
-        if not Agent.query.filter_by(phone_number=number.number).first():
-            phone_numbers.append((number.number, number.customer_id))
+    for number in db.session.query(PhoneNumber.number, PhoneNumber.customer_id).filter(non_agent_filter()).all():
+        phone_numbers.append((number.number, number.customer_id))
     
     form.redirect_to_agent.choices = agents
     form.redirect_phone_number.choices = phone_numbers
@@ -68,6 +69,7 @@ def manage_redirects():
                 if not agents_db:
                     db.session.add(redirect_rule)
                     db.session.commit()
+                    routing_table.invalidate()
                     debug_log.debug(f"Added new redirect rule: {[form.redirect_rule_name.data, form.redirect_phone_number.data, form.redirect_to_agent.data]}")
                     
                     flash(FLASH_MESSAGES.ADD_REDIRECT_RULE_SUCCESS, "success")
@@ -102,6 +104,7 @@ def manage_agents():
                     if not agent_db:
                         db.session.add(agent)
                         db.session.commit()
+                        routing_table.invalidate()
                         
                         debug_log.debug(f"Added new agent: {[form.agent_type.data, form.agent_username.data, form.agent_phone_number.data]}")
                         
@@ -133,6 +136,7 @@ def manage_agents():
                         datastore.add_role_to_user(user, "agent")
                         db.session.add(agent)
                         db.session.commit()
+                        routing_table.invalidate()
                         
                         debug_log.debug(f"Added new agent: {[form.agent_type.data, form.agent_username.data, form.agent_email.data]}")
                         
@@ -170,6 +174,7 @@ def delete_agent(id):
             
         db.session.delete(agent)
         db.session.commit()
+        routing_table.invalidate()
         
         debug_log.debug(f"Successfully deleted agent and agent rules: [{id}]")
         return redirect(url_for(".manage_agents"))
@@ -187,6 +192,7 @@ def delete_redirect_rule(id):
     if rule:
         db.session.delete(rule)
         db.session.commit()
+        routing_table.invalidate()
         
         debug_log.debug(f"Successfully deleted redirect rule: [{id}]")
         return redirect(url_for(".manage_redirects"))
@@ -84,14 +84,16 @@ class RedirectRule(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(5000))
-    phone_number = db.Column(db.String(128))
-    agent_id = db.Column(db.Integer)
+    phone_number = db.Column(db.String(128), index=True)
+    agent_id = db.Column(db.Integer, index=True)
     
     
 # ---- Messages table ----
 @dataclass
 class Message(db.Model):
     __bind_key__ = "messages"
+    __table_args__ = (db.Index("ix_message_client_number_datetime", "client_number", "datetime"),
+                      db.Index("ix_message_client_number_updated_at", "client_number", "updated_at"))
     
     id = db.Column(db.Integer, primary_key=True)
     sid = db.Column(db.String(256), unique=True)
@@ -104,6 +106,7 @@ class Message(db.Model):
     content = db.Column(db.JSON)
     type = db.Column(db.String(128))
     is_redirect = db.Column(db.Boolean)
+    updated_at = db.Column(db.DateTime, nullable=True)  # Last status or content change after the message was stored
     
 
 # ---- Phone numbers table ----
@@ -117,8 +120,61 @@ class PhoneNumber(db.Model):
     number = db.Column(db.String(128), unique=True)
     customer_id = db.Column(db.String(30), unique=True)
     display_name = db.Column(db.String(256), unique=True)
-    
-    
+
+
+# ---- Daily customer ID sequence table ----
+@dataclass
+class CustomerIdSequence(db.Model):
+    __bind_key__ = "messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.String(8), unique=True)  # Formatted as in CUSTOMER_ID_FORMAT (%d%m%Y)
+    last_value = db.Column(db.Integer)
+
+
+# ---- Content-addressed media store table ----
+@dataclass
+class StoredMedia(db.Model):
+    __bind_key__ = "messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), unique=True)
+    extension = db.Column(db.String(16))
+    size = db.Column(db.Integer)
+    ref_count = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime)
+
+
+# ---- Inbound WhatsApp API callback queue table ----
+@dataclass
+class InboundCallback(db.Model):
+    __bind_key__ = "messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30))  # msg_receive, msg_status
+    client_number = db.Column(db.String(128))
+    payload = db.Column(db.JSON)
+    received_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer)  # Failed attempts at handling the result
+    error = db.Column(db.Text, nullable=True)  # Set when the result is dead-lettered, it is then never handled again
+
+
+# ---- Outgoing WhatsApp message outbox table ----
+@dataclass
+class OutboxMessage(db.Model):
+    __bind_key__ = "messages"
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.String(64), unique=True)  # Sent as the API messageId, becomes Message.sid
+    to_number = db.Column(db.String(128))
+    type = db.Column(db.String(128))
+    content = db.Column(db.JSON)
+    is_redirect = db.Column(db.Boolean)
+    origin_phone_number = db.Column(db.String(128), nullable=True)
+    attempts = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime)
+
+
 # ---- Announcement messages table ----
 @dataclass 
 class AnnouncementMessage(db.Model):
@@ -127,6 +183,7 @@ class AnnouncementMessage(db.Model):
     level = db.Column(db.String(15))
     duration = db.Column(db.String(20))
     start_time = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, index=True)  # None for "inf"
 
 
 # ------- Flask-Security user datastore -------
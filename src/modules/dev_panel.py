@@ -15,11 +15,24 @@ from init import db, app
 from msg_dsp_text import FLASH_MESSAGES
 from utils.forms import AdminSysSettingsForm, DeveloperAddAnnouncementMessageForm
 from utils.user_config import SecretVarsFile, UserConfigFile
+from utils.inbound_queue import inbound_queue
+from utils.callback_auth import callback_authenticator, CallbackAuthenticator
+from utils.sid_filter import sid_filter
+from utils.status_coalescer import status_coalescer
+from utils.media_fetcher import media_fetcher
+from utils.media_downloads import media_downloader
+from utils.outbound_dispatcher import outbound_dispatcher
+from utils.routing_table import routing_table
+from utils.access_control import access_control
+from utils.announcements import announcement_cache, announcement_expiry
+from utils.unread_counter import unread_counter
+from utils.query_plans import explain_hot_queries
+from utils.cross_bind import benchmark as cross_bind_benchmark
 from flask_security import hash_password, current_user
 from flask_admin import BaseView, expose, AdminIndexView, Admin
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.contrib.fileadmin import FileAdmin
-from config import WORKING_DIR
+from config import AppConfig, WORKING_DIR
 from datetime import datetime
 
 
@@ -51,6 +64,22 @@ class MyModelView(ModelView):
         return access_allowed()
         
         
+class RoutingModelView(MyModelView):
+    def after_model_change(self, form, model, is_created):
+        routing_table.invalidate()
+        
+    def after_model_delete(self, model):
+        routing_table.invalidate()
+        
+        
+class PhoneNumberModelView(MyModelView):
+    def after_model_change(self, form, model, is_created):
+        unread_counter.invalidate()
+        
+    def after_model_delete(self, model):
+        unread_counter.invalidate()
+        
+        
 class MyIndexView(AdminIndexView):
     def is_accessible(self):
         return access_allowed()
@@ -142,9 +171,11 @@ class AnnouncementMessagesView(MyBaseView):
         form = DeveloperAddAnnouncementMessageForm()
         
         if request.method == "POST" and form.validate_on_submit():
-            to_db = AnnouncementMessage(message=form.message.data, level=form.level.data, duration=form.duration.data, start_time=datetime.now())
+            start_time = datetime.now()
+            to_db = AnnouncementMessage(message=form.message.data, level=form.level.data, duration=form.duration.data, start_time=start_time, expires_at=announcement_expiry(form.duration.data, start_time))
             db.session.add(to_db)
             db.session.commit()
+            announcement_cache.invalidate()
             flash("Successfully added announcement message!", "success")
         
         current_messages = AnnouncementMessage.query.all()
@@ -157,19 +188,40 @@ class AnnouncementMessagesView(MyBaseView):
         if message:
             db.session.delete(message)
             db.session.commit()
+            announcement_cache.invalidate()
             flash("Successfully deleted announcement message!", "success")
             return redirect(self.get_url("announce-msgs.index"))
         
         abort(404)
     
     
+class SystemStatsView(MyBaseView):
+    @expose("/")
+    def index(self):
+        return {"inbound_queue": inbound_queue.stats(), "callback_auth": callback_authenticator.stats(), "sid_filter": sid_filter.stats(), "status_coalescer": status_coalescer.stats(), "media_fetcher": media_fetcher.stats(), "media_downloads": media_downloader.stats(), "outbound_dispatcher": outbound_dispatcher.stats(), "routing_table": routing_table.stats(), "access_control": access_control.stats(), "announcements": announcement_cache.stats()}, 200
+    
+    @expose("/callback_auth_benchmark")
+    def callback_auth_benchmark(self):
+        # A separate instance, so the benchmark does not touch the live cache and stats
+        return CallbackAuthenticator(AppConfig.WAAPI_CALLBACK_AUTH_CACHE_SIZE).benchmark(request.args.get("iterations", 20, type=int)), 200
+    
+    @expose("/query_plans")
+    def query_plans(self):
+        return explain_hot_queries(), 200
+    
+    @expose("/cross_bind_benchmark")
+    def cross_bind_query_counts(self):
+        return cross_bind_benchmark(), 200
+    
+    
 # ------- View registry -------
 admin.add_view(SysSettingsView(name="System Config", endpoint="sys-settings"))
 admin.add_view(AnnouncementMessagesView(name="Announce. Msgs", endpoint="announce-msgs"))
+admin.add_view(SystemStatsView(name="System Stats", endpoint="sys-stats"))
 admin.add_view(MyModelView(Message, db.session, category="Database"))
-admin.add_view(MyModelView(RedirectRule, db.session, category="Database"))
-admin.add_view(MyModelView(Agent, db.session, category="Database"))
-admin.add_view(MyModelView(PhoneNumber, db.session, category="Database"))
+admin.add_view(RoutingModelView(RedirectRule, db.session, category="Database"))
+admin.add_view(RoutingModelView(Agent, db.session, category="Database"))
+admin.add_view(PhoneNumberModelView(PhoneNumber, db.session, category="Database"))
 admin.add_view(MyModelView(User, db.session, category="User Database"))
 admin.add_view(MyModelView(Role, db.session, category="User Database"))
 admin.add_view(MyFileAdmin(WORKING_DIR, endpoint="/manage-files/", name="Files"))
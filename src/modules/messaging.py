@@ -8,21 +8,27 @@
 
 
 # ------- Libraries and utils -------
-import os
+import re
 import bleach
-import uuid
-import secrets
 from config import AppConfig
 from modules.multiserver import multiserv_handle_message_change
 from msg_dsp_text import WA_SYSTEM_RESPONSES
-from flask import Blueprint, abort, request, url_for
+from flask import Blueprint, abort, request, send_from_directory
 from flask_security import auth_required, current_user
 from modules.database import Agent, Message, PhoneNumber, RedirectRule
 from init import socketio, db, debug_log
-from flask_socketio import disconnect
+from flask_socketio import disconnect, join_room
 from utils.whatsapp import WhatsApp
 from utils.global_helpers import get_cid_phone_num, get_phone_num_cid, validate_e164_phone_num, get_cid_display_name, get_display_name_cid
 from utils.whatsapp_interface import MessageStatus, MessageType
+from utils.media_store import media_store, is_media_extension
+from utils.routing_table import routing_table
+from utils.unread_counter import unread_counter
+from utils.cross_bind import non_agent_filter, agent_customer_filter
+from utils.access_control import access_control
+from sqlalchemy import tuple_
+from datetime import datetime, timedelta
+from werkzeug.http import http_date
 
 
 # ------- Blueprint init -------
@@ -31,6 +37,9 @@ messaging = Blueprint("messaging", __name__, template_folder="../templates", sta
 
 # ------- Global variables -------
 API_PREFIX = AppConfig.MESSAGING_API_PREFIX
+UPLOAD_CHUNK_SIZE = 64 * 1024
+PRIVATE_MESSAGE_FIELDS = ["client_number", "origin_phone_number", "sid"]
+ADMIN_ROOM = "admins"
 
 
 # ------- Functions -------
@@ -38,57 +47,171 @@ def ext_allowed(filename):
     return ("." in filename) and (filename.rsplit(".", 1)[1].lower() in AppConfig.ALLOWED_FILE_EXTENSIONS)
 
 
+# ---- Message as sent to the browser, without the fields that identify the customer ----
+def serialize_message(msg: Message) -> dict:
+    return {column.name: getattr(msg, column.name) for column in Message.__table__.columns if column.name not in PRIVATE_MESSAGE_FIELDS}
+
+
+# ---- Same as serialize_message() with dates formatted the way the HTTP API returns them, for Socket.IO events ----
+def serialize_message_event(msg: Message) -> dict:
+    return {key: http_date(value) if isinstance(value, datetime) else value for key, value in serialize_message(msg).items()}
+
+
+# ---- Socket.IO rooms, a socket joins its user's room (and the admin room for admins) ----
+# Membership only depends on who the user is. Which users may see a customer is worked out
+# from the routing table every time an event is emitted, so a removed redirect rule or
+# agent takes effect immediately instead of when the socket reconnects.
+def user_room(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+# ---- Rooms of the (non-admin) users whose fs_user agent the customer is redirected to ----
+def customer_agent_rooms(client_number: str) -> list:
+    return [user_room(agent.fs_user_id) for agent in routing_table.agents_for_customer(client_number) if agent.type == "fs_user" and agent.fs_user_id is not None]
+
+
+# ---- Every room that may see events for a customer ----
+def customer_event_rooms(client_number: str) -> list:
+    return [ADMIN_ROOM] + customer_agent_rooms(client_number)
+
+
+# ---- Columns of a sidebar row, loaded without building PhoneNumber objects ----
+SIDEBAR_COLUMNS = (PhoneNumber.id, PhoneNumber.customer_id, PhoneNumber.display_name, PhoneNumber.unread_msgs, PhoneNumber.last_msg, PhoneNumber.number)
+
+
+# ---- Conversation sidebar row (from a PhoneNumber or a SIDEBAR_COLUMNS row), sorted by sort_key (descending) in the browser ----
+def sidebar_row(phone_number, include_number: bool) -> dict:
+    row = {
+        "id": phone_number.id,
+        "customer_id": phone_number.customer_id,
+        "display_name": phone_number.display_name.title(),
+        "unread_msgs": phone_number.unread_msgs,
+        "last_msg": phone_number.last_msg,
+        "sort_key": phone_number.unread_msgs
+    }
+    
+    if include_number:
+        row["number"] = phone_number.number
+        
+    return row
+
+
+# ---- Sends the customer's changed sidebar row to everyone who has the customer in their sidebar ----
+def emit_sidebar_update(client_number: str):
+    if routing_table.agent_by_number(client_number):
+        return
+    
+    phone_number = db.session.query(*SIDEBAR_COLUMNS).filter(PhoneNumber.number == client_number).first()
+    
+    if not phone_number:
+        return
+    
+    agent_rooms = customer_agent_rooms(client_number)
+    socketio.emit("sidebar_update", sidebar_row(phone_number, True), to=ADMIN_ROOM)
+    
+    if agent_rooms:
+        socketio.emit("sidebar_update", sidebar_row(phone_number, False), to=agent_rooms)
+
+
+# ---- Message history cursors are "<ISO datetime>|<id>" ----
+def message_cursor(msg: Message) -> str:
+    return f"{msg.datetime.isoformat()}|{msg.id}"
+
+
+def parse_message_cursor(cursor: str) -> tuple:
+    try:
+        msg_datetime, msg_id = cursor.rsplit("|", 1)
+        return (datetime.fromisoformat(msg_datetime), int(msg_id))
+    
+    except ValueError:
+        abort(400)
+
+
+# ---- Status watermark handed to the browser, updates at or after it are sent again by get_msg_changes ----
+# It lags behind the clock so that an update stamped just before a read but committed after it is not missed,
+# updates can be sent more than once and the browser simply re-renders them.
+def changes_watermark() -> str:
+    return (datetime.now() - timedelta(seconds=AppConfig.MESSAGE_CHANGES_WATERMARK_OVERLAP_SEC)).isoformat()
+
+
+# ---- Queries used by get_msg_list and get_msg_changes (their plans are checked by utils/query_plans.py) ----
+# Keyset pagination on (datetime, id), newest page first when no cursor is given
+def message_page_query(phone_number: str, before: tuple = None, after: tuple = None):
+    query = Message.query.filter_by(client_number=phone_number)
+    
+    if after:
+        return query.filter(tuple_(Message.datetime, Message.id) > after).order_by(Message.datetime, Message.id)
+    
+    if before:
+        query = query.filter(tuple_(Message.datetime, Message.id) < before)
+    
+    return query.order_by(Message.datetime.desc(), Message.id.desc())
+
+
+def new_messages_query(phone_number: str, last_id: int):
+    return Message.query.filter_by(client_number=phone_number).filter(Message.id > last_id).order_by(Message.id)
+
+
+def updated_messages_query(phone_number: str, since: datetime, last_id: int):
+    return Message.query.filter_by(client_number=phone_number).filter(Message.updated_at >= since).filter(Message.id <= last_id).order_by(Message.id)
+
+
 # ---- This function handles WhatsApp phone message redirects ----
 def whatsapp_redirect(client_number: str, msg_obj: Message) -> bool:
     customer_id = get_cid_phone_num(client_number)
-    redirect_rules = RedirectRule.query.filter_by(phone_number=client_number).all()
-    agent = Agent.query.filter_by(phone_number=client_number).first()
+    rule_agents = routing_table.agents_for_customer(client_number)
+    agent = routing_table.agent_by_number(client_number)
     fs_user_rule = False
+    agent_redirects = []
     
-    for rule in redirect_rules:
-        agent = Agent.query.get(rule.agent_id)
-            
+    for agent in rule_agents:
         if agent.type == "fs_user":
             fs_user_rule = True
                 
         if agent.type == "phone":
             debug_log.debug(f"Received message has phone redirect rule. Redirecting message to agent via WhatsApp. {[client_number, agent.name]}") 
             
-            pn_database = PhoneNumber.query.filter_by(number=client_number).first()
-            
-            if pn_database:
-                pn_database.unread_msgs = pn_database.unread_msgs - 1
-                db.session.commit()
+            # Every agent gets its own copy, the original content must not be prefixed more than once
+            header = f"*{get_display_name_cid(customer_id).title()}*"
+            content = dict(msg_obj.content)
             
             if msg_obj.type.lower() == "text":
-                body = msg_obj.content.get("text")
-                msg_obj.content["text"] = f"*{get_display_name_cid(customer_id).title()}*" + (":\n" + body if body else "")
-                WhatsApp.send_freeform_message(msg_obj.content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number)
+                body = content.get("text")
+                content["text"] = header + (":\n" + body if body else "")
+                agent_redirects.append((content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number))
                 
             elif msg_obj.type.lower() in ["image", "video"]:
-                body = msg_obj.content.get("caption")
-                msg_obj.content["caption"] = f"*{get_display_name_cid(customer_id).title()}*" + (":\n" + body if body else "")
-                WhatsApp.send_freeform_message(msg_obj.content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number)
+                body = content.get("caption")
+                content["caption"] = header + (":\n" + body if body else "")
+                agent_redirects.append((content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number))
                 
             elif msg_obj.type.lower() in ["audio", "voice", "location", "sticker", "document"]: 
-                WhatsApp.send_freeform_message({"text": f"*{get_display_name_cid(customer_id).title()}*:"}, MessageType.TEXT, agent.phone_number, True, client_number)
-                WhatsApp.send_freeform_message(msg_obj.content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number)
+                agent_redirects.append(({"text": header + ":"}, MessageType.TEXT, agent.phone_number, True, client_number))
+                agent_redirects.append((content, MessageType.from_str(msg_obj.type), agent.phone_number, True, client_number))
+    
+    # Queued together, each agent's number is its own dispatcher lane so agents are sent to concurrently
+    if agent_redirects:
+        # The message was read by a phone agent, counted once however many phone agents got it
+        unread_counter.add(client_number, -1)
+        db.session.commit()
+        
+        WhatsApp.send_freeform_messages(agent_redirects)
                 
     if agent and agent.phone_number == client_number:
-        redirect_rules = RedirectRule.query.filter_by(agent_id=agent.id).all()
+        agent_customers = routing_table.customers_for_agent(agent.id)
         agent_single_customer = False
         agent_no_customers = False
         media_unsupported = False
         body = ""
             
-        if len(redirect_rules) == 0:
+        if len(agent_customers) == 0:
             agent_no_customers = True
             debug_log.debug(f"Received message from phone agent however the agent has no assigned customers. {[client_number, agent.name, customer_id]}")
             WhatsApp.send_freeform_message({"text": str(WA_SYSTEM_RESPONSES.AGENT_NO_CUSTOMERS)}, MessageType.TEXT, client_number, True, None)
                 
-        elif len(redirect_rules) == 1:
+        elif len(agent_customers) == 1:
             agent_single_customer = True
-            display_name = get_display_name_cid(get_cid_phone_num(redirect_rules[0].phone_number)) 
+            display_name = get_display_name_cid(get_cid_phone_num(agent_customers[0])) 
                 
         else:
             if msg_obj.type.lower() == "text":
@@ -110,7 +233,7 @@ def whatsapp_redirect(client_number: str, msg_obj: Message) -> bool:
                     phone_num = get_phone_num_cid(cid)
                         
                     if validate_e164_phone_num(phone_num):
-                        redirect_rules = RedirectRule.query.filter_by(phone_number=phone_num).all()
+                        rule_agents = routing_table.agents_for_customer(phone_num)
                         msg_sent = False
                         body_send = body
                             
@@ -125,9 +248,7 @@ def whatsapp_redirect(client_number: str, msg_obj: Message) -> bool:
                             elif msg_obj.type.lower() in ["document", "image", "video"]:
                                 msg_obj.content["caption"] = body_send
                         
-                        for rule in redirect_rules:
-                            r_agent = Agent.query.get(rule.agent_id)
-                                
+                        for r_agent in rule_agents:
                             if (agent.id == r_agent.id) and (("\n" in body) or msg_obj.type.lower() in ["document", "image", "audio", "voice", "video", "sticker"] or agent_single_customer):
                                 debug_log.debug(f"Received message from phone agent. Redirecting message to client via WhatsApp. {[client_number, agent.name, phone_num, customer_id]}")
                                 WhatsApp.send_freeform_message(msg_obj.content, MessageType.from_str(msg_obj.type), phone_num, True, client_number)
@@ -164,12 +285,20 @@ def msg_redirect_status_resp(msg_obj: Message, status: MessageStatus):
 def message_status_change(client_number: str, change: str, msg_db_id: int, msg_obj: Message):
     fs_user_send = False
     
-    if change == "msg_received":
+    # Serialized once for every viewer, before a redirect can change the content in memory
+    message = serialize_message_event(msg_obj)
+    
+    # Media messages are redirected once their file has been downloaded
+    if (change == "msg_received" and not msg_obj.content.get("mediaPending")) or change == "msg_media_ready":
         fs_user_send = whatsapp_redirect(client_number, msg_obj)
             
     debug_log.debug(f"[SocketIO] Emitting message update event! {[client_number, change, msg_db_id]}")
     multiserv_handle_message_change(change)
-    socketio.emit("message_change", {"client_number": client_number, "change": change, "msg_db_id": msg_db_id})
+    socketio.emit("message_change", {"client_number": client_number, "change": change, "msg_db_id": msg_db_id, "message": message}, to=customer_event_rooms(client_number))
+    
+    # The redirect of a media message, which can change the unread count, only happens once its file is ready
+    if change in ["msg_received", "msg_media_ready"]:
+        emit_sidebar_update(client_number)
 
 
 # ------- API routes -------
@@ -179,75 +308,83 @@ def get_msg_list(customer_id):
     phone_number = get_phone_num_cid(bleach.clean(customer_id))
     
     if phone_number:
-        user_id = current_user.id 
-        agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-        redirect_rules = db.session.query(RedirectRule).filter_by(phone_number=phone_number).all()
-        rule_avail = False
-        
-        for rule in redirect_rules:
-            if agent and rule.agent_id == agent.id:
-                rule_avail = True
-                
-        if rule_avail or current_user.has_role("admin"):
-            msg_list = Message.query.filter_by(client_number=phone_number).all()
-            msg_list_dict = []
+        if access_control.can_access(current_user, phone_number):
+            limit = min(max(request.args.get("limit", AppConfig.MESSAGE_PAGE_SIZE, type=int), 1), AppConfig.MESSAGE_PAGE_SIZE_MAX)
+            before = request.args.get("before")
+            after = request.args.get("after")
+            query = message_page_query(phone_number, parse_message_cursor(before) if before else None, parse_message_cursor(after) if after else None)
             
-            if msg_list:
-                for msg in msg_list:
-                    delattr(msg, "_sa_instance_state")
-        
-                    msg_dict = msg.__dict__
-                    msg_dict.pop("client_number", None)
-                    msg_dict.pop("origin_phone_number", None)
-                    msg_dict.pop("sid", None)
-                    
-                    msg_list_dict.append(msg_dict)
+            watermark = changes_watermark()
+            msg_list = query.limit(limit + 1).all()
+            has_more = len(msg_list) > limit
+            msg_list = msg_list[:limit]
             
-            ret = sorted(msg_list_dict, key=lambda d: d.get("datetime", float("inf")), reverse=False)
-            return ret, 200
+            if not after:
+                msg_list.reverse()
+            
+            return {
+                "messages": [serialize_message(msg) for msg in msg_list],
+                "before": message_cursor(msg_list[0]) if msg_list and has_more and not after else None,
+                "after": message_cursor(msg_list[-1]) if msg_list else after,
+                "has_more": has_more,
+                "watermark": watermark
+            }, 200
     
     debug_log.debug(f"[{request.remote_addr}] Attempted to request messages list for a number that is not in their redirects list. [{phone_number}]")
     abort(404)
+
+
+# ---- New messages after last_id and status/content changes since the watermark, for reconnecting clients ----
+@messaging.route(API_PREFIX + "/get_message_changes/<customer_id>")
+@auth_required("session")
+def get_msg_changes(customer_id):
+    phone_number = get_phone_num_cid(bleach.clean(customer_id))
+    
+    if phone_number:
+        if access_control.can_access(current_user, phone_number):
+            last_id = request.args.get("last_id", 0, type=int)
+            
+            try:
+                since = datetime.fromisoformat(request.args.get("since", ""))
+                
+            except ValueError:
+                abort(400)
+            
+            watermark = changes_watermark()
+            new_msgs = new_messages_query(phone_number, last_id).limit(AppConfig.MESSAGE_PAGE_SIZE_MAX + 1).all()
+            has_more = len(new_msgs) > AppConfig.MESSAGE_PAGE_SIZE_MAX
+            new_msgs = new_msgs[:AppConfig.MESSAGE_PAGE_SIZE_MAX]
+            updated_msgs = updated_messages_query(phone_number, since, last_id).all()
+            
+            return {
+                "messages": [serialize_message(msg) for msg in new_msgs],
+                "updates": [serialize_message(msg) for msg in updated_msgs],
+                "last_id": new_msgs[-1].id if new_msgs else last_id,
+                "has_more": has_more,
+                "watermark": watermark if not has_more else since.isoformat()
+            }, 200
+    
+    debug_log.debug(f"[{request.remote_addr}] Attempted to request message changes for a number that is not in their redirects list. [{phone_number}]")
+    abort(404)
     
     
 @messaging.route(API_PREFIX + "/get_phones_list")
 @auth_required("session")
 def get_pns_list():
-    user_id = current_user.id 
-    agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-    redirect_rules = []
-    
-    if agent:
-        redirect_rules = db.session.query(RedirectRule).filter_by(agent_id=agent.id).all()
+    is_admin = current_user.has_role("admin")
     
-    phone_nums_belong = []
+    query = db.session.query(*SIDEBAR_COLUMNS).filter(non_agent_filter())
     
-    if current_user.has_role("admin"):
-        phones = PhoneNumber.query.all()
+    if not is_admin:
+        agent = access_control.user_agent(current_user.id)
         
-        for num in phones:
-            if not Agent.query.filter_by(phone_number=num.number).first():
-                delattr(num, "_sa_instance_state")
-                
-                num = num.__dict__
-                num["display_name"] = num.get("display_name").title()
-                phone_nums_belong.append(num)
+        if not agent:
+            return [], 200
         
-    else:
-        for rule in redirect_rules:
-            phone_num = PhoneNumber.query.filter_by(number=rule.phone_number).first()
-            
-            if phone_num:
-                if not Agent.query.filter_by(phone_number=phone_num.number).first():
-                    delattr(phone_num, "_sa_instance_state")
-                    
-                    phone_num = phone_num.__dict__
-                    phone_num["display_name"] = phone_num.get("display_name").title()
-                    phone_num.pop("number", None)
-                    phone_nums_belong.append(phone_num)
-            
-    ret = sorted(phone_nums_belong, key=lambda d: d.get("unread_msgs", float("inf")), reverse=True)
-    return ret, 200
+        query = query.filter(agent_customer_filter(agent.id))
+    
+    phone_nums = query.order_by(PhoneNumber.unread_msgs.desc(), PhoneNumber.id).all()
+    return [sidebar_row(num, is_admin) for num in phone_nums], 200
     
     
 @messaging.route(API_PREFIX + "/get_message_db_id/<id>")
@@ -260,24 +397,8 @@ def get_msg_db_id(id):
         phone_number = msg.client_number
         
         if phone_number:
-            user_id = current_user.id 
-            agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-            redirect_rules = db.session.query(RedirectRule).filter_by(phone_number=phone_number).all()
-            rule_avail = False
-            
-            for rule in redirect_rules:
-                if agent and rule.agent_id == agent.id:
-                    rule_avail = True
-                    
-            if rule_avail or current_user.has_role("admin"):
-                delattr(msg, "_sa_instance_state")
-                    
-                msg_dict = msg.__dict__
-                msg_dict.pop("client_number", None)
-                msg_dict.pop("origin_phone_number", None)
-                msg_dict.pop("sid", None)
-                        
-                return msg_dict, 200
+            if access_control.can_access(current_user, phone_number):
+                return serialize_message(msg), 200
     
     debug_log.debug(f"[{request.remote_addr}] Attempted to request messages from a number that is not in their redirects list or provided db id is invalid. [{id}]")
     abort(404)
@@ -290,17 +411,11 @@ def handle_file_upload():
     file_urls = []
     
     try:
-        if files[0].filename:
-            folder_uuid = secrets.token_urlsafe()
-            path = os.path.join(AppConfig.UPLOAD_FOLDER, f"message_media/{folder_uuid}")
-            os.mkdir(path)
-        
         for file in files:
             if file.filename != "":
                 if ext_allowed(file.filename):
-                    file_uuid = uuid.uuid4()
-                    file.save(os.path.join(path, f"{file_uuid}.{file.filename.rsplit('.', 1)[1]}"))
-                    file_urls.append(url_for("static", filename=f"{AppConfig.UPLOAD_FOLDER_STATIC_RELATIVE}/message_media/{folder_uuid}/{file_uuid}.{file.filename.rsplit('.', 1)[1]}", _external=True, _scheme=AppConfig.HTTP_SCHEME))
+                    stored_media = media_store.store_chunks(iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""), file.filename.rsplit(".", 1)[1])
+                    file_urls.append(media_store.url(*stored_media))
                     
         debug_log.debug(f"File upload for messages successful. Saved {len(files)} file(s).")
                     
@@ -311,6 +426,16 @@ def handle_file_upload():
     return {"files": file_urls}, 200
 
 
+@messaging.route("/media/<digest>.<ext>")
+def get_stored_media(digest, ext):
+    if not (re.fullmatch(r"[0-9a-f]{64}", digest) and is_media_extension(ext)):
+        abort(404)
+    
+    response = send_from_directory(media_store.file_dir(digest), f"{digest}.{ext}", max_age=AppConfig.MEDIA_STORE_CACHE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
+
+
 # ------- SocketIO -------
 @socketio.on("disconnect")
 def handle_socket_connect():
@@ -335,16 +460,12 @@ def handle_client_connect(json: dict):
     debug_log.debug(f"[SocketIO] Received [user_client_connect] event from [{request.remote_addr}] - [{phone_number}]")
     
     if phone_number:
-        if current_user.has_role("admin") or phone_number == "NO_CHAT_PAGE":
+        if phone_number == "NO_CHAT_PAGE" or access_control.can_access(current_user, phone_number):
+            if current_user.has_role("admin"):
+                join_room(ADMIN_ROOM)
+                
+            join_room(user_room(current_user.id))
             return
-        
-        user_id = current_user.id 
-        agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-        redirect_rules = db.session.query(RedirectRule).filter_by(phone_number=phone_number).all()
-        
-        for rule in redirect_rules:
-            if agent and rule.agent_id == agent.id:
-                return
     
         debug_log.debug(f"[SocketIO] Connection attempt from a user who doesn't have the requested phone number in their redirects list, disconnecting. [{phone_number}]")
     disconnect()
@@ -361,16 +482,7 @@ def handle_client_msg_receive(json: dict, methods=["GET", "POST"]):
     files = json.get("files")
     
     if phone_number and (message or files):
-        user_id = current_user.id 
-        agent = db.session.query(Agent).filter_by(type="fs_user").filter_by(fs_user_id=user_id).first()
-        redirect_rules = db.session.query(RedirectRule).filter_by(phone_number=phone_number).all()
-        rule_avail = False
-        
-        for rule in redirect_rules:
-            if agent and rule.agent_id == agent.id:
-                rule_avail = True
-                
-        if rule_avail or current_user.has_role("admin"):
+        if access_control.can_access(current_user, phone_number):
             if files:
                 for i, file in enumerate(files):
                     file_ext = file.split(".")
@@ -11,7 +11,7 @@
 from config import AppConfig
 from flask import Blueprint, request
 from init import socketio, debug_log
-from modules.database import PhoneNumber
+from utils.unread_counter import unread_counter
 
 
 # ------- Blueprint init -------
@@ -24,13 +24,7 @@ API_PREFIX = AppConfig.MULTISERVER_API_PREFIX
 
 # ------- Functions -------
 def get_total_unread_msgs() -> int:
-    phone_numbers = PhoneNumber.query.all()
-    total_unread_messages = 0
-        
-    for number in phone_numbers:
-        total_unread_messages = total_unread_messages + int(number.unread_msgs)
-        
-    return total_unread_messages
+    return unread_counter.total()
 
 
 # ------- SocketIO -------
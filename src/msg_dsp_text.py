@@ -26,6 +26,7 @@ class UI_ELEMENTS_TEXT:
     TITLE_HOME = lazy_gettext("Mesajlar")
     MEDIA_ATTACHMENT = lazy_gettext("Dosya Eklentisi")
     LOCATION_ATTACHMENT = lazy_gettext("Konum Eklentisi")
+    MEDIA_PENDING = lazy_gettext("Dosya indiriliyor...")
 
     FOOTER_COPYRIGHT = lazy_gettext("Copyright © 2023 Samyar Sadat Akhavi")
     FOOTER_PRIVACY_POLICY = lazy_gettext("Privacy Policy")
@@ -0,0 +1,76 @@
+#  WhatsApp messaging client project
+#  Customer visibility (access control) utility
+
+
+# ------- Libraries and utils -------
+import threading
+from typing import Union
+from utils.routing_table import routing_table, AgentEntry
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Which customers each user is allowed to see ----
+# Admins can see every customer, other users only the customers redirected to their
+# fs_user agent. The per-user sets are built from the routing table and dropped whenever
+# the routing table is invalidated (any Agent or RedirectRule change), so checks after
+# the first one never touch the database.
+class AccessControl():
+    def __init__(self):
+        self._users = {}
+        self._version = None
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+
+
+    # ---- The user's fs_user agent, if they have one ----
+    def user_agent(self, user_id: int) -> Union[AgentEntry, None]:
+        agent = routing_table.agent_by_fs_user(user_id)
+
+        if agent and agent.type == "fs_user":
+            return agent
+
+        return None
+
+
+    def visible_customers(self, user_id: int) -> frozenset:
+        version = routing_table.version
+
+        with self._lock:
+            if self._version != version:
+                self._users = {}
+                self._version = version
+
+            customers = self._users.get(user_id)
+
+            if customers is not None:
+                self._hits += 1
+                return customers
+
+            self._misses += 1
+
+        agent = self.user_agent(user_id)
+        customers = frozenset(routing_table.customers_for_agent(agent.id)) if agent else frozenset()
+
+        with self._lock:
+            # Not cached if the routing table was invalidated in the meantime
+            if self._version == version:
+                self._users[user_id] = customers
+
+        return customers
+
+
+    def can_access(self, user, phone_number: str) -> bool:
+        return user.has_role("admin") or phone_number in self.visible_customers(user.id)
+
+
+    def stats(self) -> dict:
+        return {
+            "cached_users": len(self._users),
+            "hits": self._hits,
+            "misses": self._misses
+        }
+
+
+access_control = AccessControl()
@@ -0,0 +1,150 @@
+#  WhatsApp messaging client project
+#  Announcement message expiry and cache utility
+
+
+# ------- Libraries and utils -------
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Union
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from config import AppConfig
+from init import app, db, socketio, log, debug_log
+from modules.database import AnnouncementMessage
+
+
+# ------- Global variables -------
+SESSION_INVALIDATE_KEY = "announcements_changed"
+DURATION_UNITS = {"mt": "minutes", "hr": "hours", "wk": "weeks"}
+
+
+# -=-=-= Functions =-=-=-
+# ---- Gets when an announcement with a duration option ("inf", "30-mt", "12-hr", "1-wk", ...) expires ----
+def announcement_expiry(duration: str, start_time: datetime) -> Union[datetime, None]:
+    if duration == "inf":
+        return None
+
+    amount, unit = duration.split("-")
+    return start_time + timedelta(**{DURATION_UNITS[unit]: int(amount)})
+
+
+# -=-=-= Models =-=-=-
+# ---- Detached copy of an announcement, safe to share between requests ----
+@dataclass(frozen=True)
+class AnnouncementEntry():
+    id: int
+    message: str
+    level: str
+    expires_at: Union[datetime, None]
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Active announcements, loaded with one query and kept in memory ----
+# Expired rows are deleted by a background sweep every ANNOUNCEMENT_SWEEP_INTERVAL_SEC,
+# which also reloads the cache (picking up changes made by other processes). Anything
+# that adds or deletes an AnnouncementMessage must call invalidate() after committing,
+# or invalidate_on_commit() if the caller commits.
+class AnnouncementCache():
+    def __init__(self, sweep_interval: float):
+        self.sweep_interval = sweep_interval
+        self._entries = None
+        self._lock = threading.Lock()
+        self._started = False
+
+        self._loads = 0
+        self._expired = 0
+
+
+    def active(self) -> list[AnnouncementEntry]:
+        with self._lock:
+            entries = self._entries
+
+        if entries is None:
+            entries = self._load()
+
+        now = datetime.now()
+        return [entry for entry in entries if entry.expires_at is None or entry.expires_at > now]
+
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+
+    def invalidate_on_commit(self):
+        db.session.info[SESSION_INVALIDATE_KEY] = True
+
+
+    # ---- Deletes expired announcements and reloads the cache ----
+    def sweep(self):
+        now = datetime.now()
+
+        # Rows from before expires_at existed
+        for msg in AnnouncementMessage.query.filter(AnnouncementMessage.expires_at.is_(None), AnnouncementMessage.duration != "inf").all():
+            msg.expires_at = announcement_expiry(msg.duration, msg.start_time)
+
+        expired = AnnouncementMessage.query.filter(AnnouncementMessage.expires_at <= now).delete(synchronize_session=False)
+        db.session.commit()
+
+        if expired:
+            self._expired += expired
+            debug_log.debug(f"[Announcements] Cleared {expired} expired announcement message(s).")
+
+        self.invalidate()
+        self._load()
+
+
+    def start(self):
+        if self._started:
+            return
+
+        self._started = True
+        socketio.start_background_task(self._sweep_loop)
+
+
+    def stats(self) -> dict:
+        entries = self._entries
+
+        return {
+            "cached": len(entries) if entries is not None else None,
+            "loads": self._loads,
+            "expired": self._expired
+        }
+
+
+    def _load(self) -> list[AnnouncementEntry]:
+        entries = [AnnouncementEntry(msg.id, msg.message, msg.level, msg.expires_at) for msg in AnnouncementMessage.query.order_by(AnnouncementMessage.id).all()]
+
+        with self._lock:
+            self._entries = entries
+            self._loads += 1
+
+        return entries
+
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    self.sweep()
+
+            except Exception:
+                log.error("[Announcements] An exception occured whilst clearing expired announcement messages:", exc_info=1)
+
+            socketio.sleep(self.sweep_interval)
+
+
+announcement_cache = AnnouncementCache(AppConfig.ANNOUNCEMENT_SWEEP_INTERVAL_SEC)
+
+
+# -=-=-= Session events =-=-=-
+@event.listens_for(Session, "after_commit")
+def invalidate_changed_announcements(session: Session):
+    if session.info.pop(SESSION_INVALIDATE_KEY, False):
+        announcement_cache.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_announcement_changes(session: Session):
+    session.info.pop(SESSION_INVALIDATE_KEY, None)
@@ -0,0 +1,186 @@
+#  WhatsApp messaging client project
+#  WhatsApp API callback authentication utility
+
+
+# ------- Libraries and utils -------
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Union
+from config import AppConfig
+from flask_security import verify_password
+from urllib.parse import urlencode
+
+
+# ------- Global variables -------
+AUTH_MODES = ["kdf", "cached", "hmac"]
+MAX_BENCHMARK_ITERATIONS = 20  # The KDF mode blocks the worker for every iteration
+
+
+# -=-=-= Functions =-=-=-
+# ---- Checks callback credentials against the stored password hash (slow, uses the KDF) ----
+def check_call_creds(username: str, password: str) -> bool:
+    if username == AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER and verify_password(password, AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS_HASH):
+        return True
+
+    return False
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Authenticates WhatsApp API callback requests ----
+# Modes (WAAPI_CALLBACK_AUTH_MODE):
+#   kdf:    Every request is checked with verify_password().
+#   cached: Credentials that passed the KDF once are remembered as an HMAC digest keyed
+#           with the stored password hash, so changing the password invalidates the cache.
+#   hmac:   Callback URLs carry a token signed with the app secret key. The signed value
+#           includes the time the token was issued, tokens older than
+#           WAAPI_CALLBACK_TOKEN_MAX_AGE_SEC (or from the future) are rejected, which limits
+#           how long a captured callback URL can be replayed. Requests without a token fall
+#           back to the cached credential check.
+class CallbackAuthenticator():
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._kdf_checks = 0
+        self._token_checks = 0
+        self._failures = 0
+
+
+    def _credentials_digest(self, username: str, password: str) -> bytes:
+        key = str(AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS_HASH).encode()
+        return hmac.new(key, f"{username}\x00{password}".encode(), hashlib.sha256).digest()
+
+
+    def _token_digest(self, issued_at: int) -> str:
+        message = f"{issued_at}\x00{AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER}\x00{AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS_HASH}".encode()
+        return hmac.new(str(AppConfig.SECRET_KEY).encode(), message, hashlib.sha256).hexdigest()
+
+
+    # ---- Token in the form <issued at (unix time)>-<signature> ----
+    def callback_token(self, issued_at: Union[int, None] = None) -> str:
+        issued_at = int(time.time()) if issued_at is None else issued_at
+        return f"{issued_at}-{self._token_digest(issued_at)}"
+
+
+    # ---- Query string that has to be appended to callback URLs given to the API ----
+    def callback_query_string(self, mode: str = None) -> str:
+        if (mode or AppConfig.WAAPI_CALLBACK_AUTH_MODE) == "hmac":
+            return "?" + urlencode({"token": self.callback_token()})
+
+        return "?" + urlencode({"user": AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER, "pass": AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS})
+
+
+    def _check_kdf(self, username: str, password: str) -> bool:
+        self._kdf_checks += 1
+        return check_call_creds(username, password)
+
+
+    def _check_cached(self, username: str, password: str) -> bool:
+        digest = self._credentials_digest(username, password)
+
+        # The digest is keyed, so looking it up does not leak anything about the password
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                self._cache_hits += 1
+                return True
+
+            self._cache_misses += 1
+
+        if not self._check_kdf(username, password):
+            return False
+
+        with self._lock:
+            self._cache[digest] = True
+
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return True
+
+
+    def _check_token(self, token: str) -> bool:
+        self._token_checks += 1
+        issued_at, separator, digest = token.partition("-")
+
+        if not (separator and issued_at.isdigit()):
+            return False
+
+        age = time.time() - int(issued_at)
+
+        if age > AppConfig.WAAPI_CALLBACK_TOKEN_MAX_AGE_SEC or age < -AppConfig.WAAPI_CALLBACK_TOKEN_MAX_SKEW_SEC:
+            return False
+
+        return hmac.compare_digest(digest, self._token_digest(int(issued_at)))
+
+
+    def authenticate(self, args: dict, mode: str = None) -> bool:
+        mode = mode or AppConfig.WAAPI_CALLBACK_AUTH_MODE
+        username = args.get("user")
+        password = args.get("pass")
+        token = args.get("token")
+        authenticated = False
+
+        if mode == "hmac" and token:
+            authenticated = self._check_token(token)
+
+        elif username and password:
+            if mode == "kdf":
+                authenticated = self._check_kdf(username, password)
+
+            else:
+                authenticated = self._check_cached(username, password)
+
+        if not authenticated:
+            self._failures += 1
+
+        return authenticated
+
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+
+    def stats(self) -> dict:
+        return {
+            "mode": AppConfig.WAAPI_CALLBACK_AUTH_MODE,
+            "cache_size": len(self._cache),
+            "cache_hits": self._cache_hits,
+            "cache_misses": self._cache_misses,
+            "kdf_checks": self._kdf_checks,
+            "token_checks": self._token_checks,
+            "failures": self._failures
+        }
+
+
+    # ---- Micro-benchmark: average time (ms) per callback authentication for each mode ----
+    # Run it on a separate instance, it fills the cache and counts towards the stats.
+    def benchmark(self, iterations: int = 20) -> dict:
+        iterations = min(max(iterations, 1), MAX_BENCHMARK_ITERATIONS)
+        results = {}
+        mode_args = {
+            "kdf": {"user": AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER, "pass": AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS},
+            "cached": {"user": AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER, "pass": AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS},
+            "hmac": {"token": self.callback_token()}
+        }
+
+        for mode in AUTH_MODES:
+            self.authenticate(mode_args[mode], mode)  # Warm-up (fills the cache for the cached mode)
+            start = time.perf_counter()
+
+            for i in range(iterations):
+                self.authenticate(mode_args[mode], mode)
+
+            results[mode] = round((time.perf_counter() - start) * 1000 / iterations, 4)
+
+        return {"iterations": iterations, "avg_ms_per_auth": results}
+
+
+callback_authenticator = CallbackAuthenticator(AppConfig.WAAPI_CALLBACK_AUTH_CACHE_SIZE)
@@ -0,0 +1,91 @@
+#  WhatsApp messaging client project
+#  Filters that join customers with agents across database binds
+
+
+# ------- Libraries and utils -------
+from sqlalchemy import MetaData, Table, event, exists, select
+from contextlib import contextmanager
+from config import AppConfig
+from init import db
+from modules.database import Agent, PhoneNumber, RedirectRule
+from utils.routing_table import routing_table
+
+
+# ------- Global variables -------
+ATTACHED_METADATA = MetaData()
+
+
+# -=-=-= Functions =-=-=-
+# ---- Whether target_bind is ATTACHed to every connection of bind_key (see SQLITE_ATTACHED_BINDS) ----
+def is_attached(bind_key: str, target_bind: str) -> bool:
+    return target_bind in AppConfig.SQLITE_ATTACHED_BINDS.get(bind_key, []) and db.engines[bind_key].dialect.name == "sqlite"
+
+
+# ---- Copy of a model's table under the schema name of an attached database ----
+def attached_table(model, schema: str) -> Table:
+    key = f"{schema}.{model.__tablename__}"
+
+    if key in ATTACHED_METADATA.tables:
+        return ATTACHED_METADATA.tables[key]
+
+    return model.__table__.to_metadata(ATTACHED_METADATA, schema=schema)
+
+
+# ---- PhoneNumber filter that leaves out numbers belonging to agents ----
+# With the agents database attached this is a NOT EXISTS subquery, otherwise the agent
+# numbers come from the routing table.
+def non_agent_filter():
+    if is_attached("messages", "agents"):
+        agent_table = attached_table(Agent, "agents")
+        return ~exists().where(agent_table.c.phone_number == PhoneNumber.number)
+
+    return PhoneNumber.number.not_in(routing_table.agent_numbers())
+
+
+# ---- PhoneNumber filter that keeps only the customers redirected to an agent ----
+def agent_customer_filter(agent_id: int):
+    if is_attached("messages", "agents"):
+        rule_table = attached_table(RedirectRule, "agents")
+        return PhoneNumber.number.in_(select(rule_table.c.phone_number).where(rule_table.c.agent_id == agent_id))
+
+    return PhoneNumber.number.in_(routing_table.customers_for_agent(agent_id))
+
+
+# ---- Counts the statements executed on any bind inside the block ----
+@contextmanager
+def count_queries():
+    counts = {"queries": 0}
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        counts["queries"] += 1
+
+    engines = set(db.engines.values())
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", on_execute)
+
+    try:
+        yield counts
+
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", on_execute)
+
+
+# ---- Queries needed to list the customers (excluding agents) for the sidebar and the redirect forms ----
+# "per_row" is the old loop with one agent lookup per phone number, "filtered" uses
+# non_agent_filter() with a cold routing table (so its two build queries are counted).
+def benchmark() -> dict:
+    results = {}
+
+    with count_queries() as counts:
+        rows = [number for number in PhoneNumber.query.all() if not Agent.query.filter_by(phone_number=number.number).first()]
+
+    results["per_row"] = {"queries": counts["queries"], "rows": len(rows)}
+    routing_table.invalidate()
+
+    with count_queries() as counts:
+        rows = db.session.query(PhoneNumber.number, PhoneNumber.customer_id).filter(non_agent_filter()).all()
+
+    results["filtered"] = {"queries": counts["queries"], "rows": len(rows), "attached": is_attached("messages", "agents")}
+    return results
@@ -0,0 +1,201 @@
+#  WhatsApp messaging client project
+#  Inbound WhatsApp API callback ingestion queue
+
+
+# ------- Libraries and utils -------
+import random
+from init import db, socketio, log, debug_log
+from config import AppConfig
+from datetime import datetime, timedelta
+from modules.database import InboundCallback
+from utils.work_queue import KeyedWorkQueue
+from utils.status_coalescer import status_coalescer
+from typing import Union
+from utils.whatsapp_interface import receive_result_to_message_obj, status_result_to_message_obj
+
+
+# -=-=-= Functions =-=-=-
+# ---- Gets the customer's phone number (the ordering key) from a raw callback result ----
+def get_result_client_number(kind: str, result: dict) -> str:
+    if kind == "msg_receive":
+        return f'+{result.get("from")}'
+
+    return f'+{result.get("to")}'
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Persists callback results and processes them in the background ----
+# Callback requests are answered as soon as their results are written to the
+# InboundCallback table. Rows are only deleted once they have been handled, so
+# anything left over after a crash is picked up again by recover() on startup.
+#
+# Status updates are coalesced per batch. A batch of only status updates is held back
+# until its oldest one is WAAPI_STATUS_COALESCE_WINDOW_SEC old, and a status update for
+# a message that is not recorded yet is kept and retried for WAAPI_UNMATCHED_STATUS_TTL_SEC.
+#
+# A batch that raises is put back on its lane and retried with a jittered exponential
+# backoff. Once its rows have failed INBOUND_MAX_ATTEMPTS times, they are handled one by
+# one and a row that still fails is dead-lettered: its error is stored on the row, and it
+# is kept for inspection but never handled again, also not by recover().
+class InboundCallbackQueue():
+    def __init__(self):
+        self.queue = KeyedWorkQueue("inbound_callbacks", self._handle_batch, AppConfig.INBOUND_QUEUE_WORKERS, AppConfig.INBOUND_QUEUE_MAX_BATCH_SIZE)
+        self._dead_lettered = 0
+
+
+    def ingest(self, kind: str, results: list):
+        now = datetime.now()
+        rows = []
+
+        for result in results or []:
+            rows.append(InboundCallback(kind=kind, client_number=get_result_client_number(kind, result), payload=result, received_at=now, attempts=0))
+
+        db.session.add_all(rows)
+        db.session.commit()
+
+        for row in rows:
+            self.queue.submit(row.client_number, row.id)
+
+        debug_log.debug(f"[Inbound Queue] Persisted and queued {len(rows)} [{kind}] callback result(s).")
+        return "OK", 200
+
+
+    def recover(self):
+        rows = InboundCallback.query.filter(InboundCallback.error.is_(None)).order_by(InboundCallback.id).all()
+
+        for row in rows:
+            self.queue.submit(row.client_number, row.id, row.received_at.timestamp())
+
+        if rows:
+            debug_log.debug(f"[Inbound Queue] Re-queued {len(rows)} unprocessed callback result(s) from the database.")
+
+
+    def start(self):
+        self.recover()
+        self.queue.start()
+
+
+    def stats(self) -> dict:
+        stats = self.queue.stats()
+        stats.update({
+            "dead_lettered": self._dead_lettered,
+            "dead_letter_rows": InboundCallback.query.filter(InboundCallback.error.isnot(None)).count()
+        })
+
+        return stats
+
+
+    def _resubmit_later(self, client_number: str, ids: list, delay: float):
+        socketio.sleep(delay)
+
+        for id in ids:
+            self.queue.submit(client_number, id)
+
+
+    def _handle_batch(self, client_number: str, ids: list) -> Union[float, None]:
+        rows = InboundCallback.query.filter(InboundCallback.id.in_(ids)).filter(InboundCallback.error.is_(None)).order_by(InboundCallback.id).all()
+
+        if rows and all(row.kind == "msg_status" for row in rows):
+            hold_back = status_coalescer.hold_back(min(row.received_at for row in rows))
+
+            if hold_back:
+                return hold_back
+
+        try:
+            return self._handle_rows(client_number, rows)
+
+        except Exception:
+            db.session.rollback()
+            log.error(f"[Inbound Queue] An exception occured whilst handling callback results for [{client_number}]:", exc_info=1)
+
+        rows = InboundCallback.query.filter(InboundCallback.id.in_(ids)).filter(InboundCallback.error.is_(None)).order_by(InboundCallback.id).all()
+
+        if not rows:
+            return None
+
+        attempts = max(row.attempts or 0 for row in rows) + 1
+
+        for row in rows:
+            row.attempts = attempts
+
+        db.session.commit()
+
+        if attempts < AppConfig.INBOUND_MAX_ATTEMPTS:
+            retry_delay = AppConfig.INBOUND_RETRY_BASE_SEC * (2 ** (attempts - 1)) * random.uniform(0.5, 1.5)
+            debug_log.debug(f"[Inbound Queue] Attempt {attempts} at handling {len(rows)} callback result(s) for [{client_number}] failed, retrying in {round(retry_delay, 2)}s.")
+            return retry_delay
+
+        # Handled one by one, so that only the rows that cause the failure are dead-lettered
+        for id in [row.id for row in rows]:
+            try:
+                retry_delay = self._handle_rows(client_number, InboundCallback.query.filter_by(id=id).all())
+
+            except Exception as error:
+                db.session.rollback()
+                self._dead_letter(id, error)
+                continue
+
+            # Rows that were handled are gone, a retried batch starts at the first row that is left
+            if retry_delay is not None:
+                return retry_delay
+
+        return None
+
+
+    def _dead_letter(self, id: int, error: Exception):
+        row = InboundCallback.query.get(id)
+        row.error = repr(error)
+        db.session.commit()
+
+        self._dead_lettered += 1
+        log.error(f"[Inbound Queue] Giving up on a [{row.kind}] callback result for [{row.client_number}] after {row.attempts} attempt(s), it is kept as a dead letter. [{row.id}, {row.error}]")
+
+
+    # ---- Handles the rows and deletes them in one commit, returns a delay to retry the batch later ----
+    def _handle_rows(self, client_number: str, rows: list) -> Union[float, None]:
+        ids = [row.id for row in rows]
+        runs = []
+        kept_ids = []
+        unmatched_expiry = datetime.now() - timedelta(seconds=AppConfig.WAAPI_UNMATCHED_STATUS_TTL_SEC)
+
+        # Results of the same kind that follow each other are handled as one batch
+        for row in rows:
+            if runs and runs[-1][0] == row.kind:
+                runs[-1][1].append(row)
+
+            else:
+                runs.append((row.kind, [row]))
+
+        from utils.whatsapp import WhatsApp, CustomerLimitReached
+
+        for kind, run_rows in runs:
+            if kind == "msg_receive":
+                try:
+                    WhatsApp.handle_message_receive([receive_result_to_message_obj(row.payload) for row in run_rows])
+
+                # The rows are kept, the customer's messages are stored once there are customer IDs left
+                except CustomerLimitReached:
+                    debug_log.debug(f"[Inbound Queue] Customer limit reached, deferring callback results for [{client_number}].")
+                    return AppConfig.INBOUND_CUSTOMER_LIMIT_RETRY_SEC
+
+            elif kind == "msg_status":
+                results = [status_result_to_message_obj(row.payload) for row in run_rows]
+                unmatched = WhatsApp.handle_message_status_call(results)
+
+                for row, result in zip(run_rows, results):
+                    if result.message_id in unmatched:
+                        if row.received_at > unmatched_expiry:
+                            kept_ids.append(row.id)
+
+                        else:
+                            debug_log.debug(f"[Inbound Queue] Dropping a status update for a message that was never recorded. [{result.message_id}]")
+
+        InboundCallback.query.filter(InboundCallback.id.in_([id for id in ids if id not in kept_ids])).delete(synchronize_session=False)
+        db.session.commit()
+
+        # Retried at the end of the lane, so that they do not hold up the customer's other callbacks
+        if kept_ids:
+            socketio.start_background_task(self._resubmit_later, client_number, kept_ids, AppConfig.WAAPI_UNMATCHED_STATUS_RETRY_SEC)
+
+
+inbound_queue = InboundCallbackQueue()
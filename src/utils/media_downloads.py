@@ -0,0 +1,100 @@
+#  WhatsApp messaging client project
+#  Deferred inbound media download utility
+
+
+# ------- Libraries and utils -------
+from typing import Union
+from datetime import datetime
+from config import AppConfig
+from init import db, debug_log
+from modules.database import Message
+from utils.media_store import media_store
+from utils.work_queue import KeyedWorkQueue
+from utils.whatsapp_interface import WhatsAppApiInterface, MessageType
+
+
+# ------- Global variables -------
+MEDIA_DOWNLOAD_FAILURE_TEXT = "System Error: Media Download Failure"
+
+
+# -=-=-= Functions =-=-=-
+# ---- Content stored for an inbound media message until its file has been downloaded ----
+def pending_media_content(message: dict) -> dict:
+    content = {"mediaPending": True, "mediaSource": message.get("url")}
+
+    if message.get("caption"):
+        content["caption"] = message.get("caption")
+
+    return content
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Downloads inbound media in the background and fills in the message once the file is ready ----
+# Inbound media messages are stored straight away with pending_media_content(). Downloads are
+# retried with exponential backoff, after the last attempt the message is turned into an error text.
+# Either way a "msg_media_ready" change is emitted for the message.
+class DeferredMediaDownloader():
+    def __init__(self):
+        self.queue = KeyedWorkQueue("media_downloads", self._handle_download, AppConfig.WAAPI_MEDIA_FETCH_WORKERS)
+
+
+    def submit(self, msg: Message):
+        self.queue.submit(str(msg.id), {"msg_id": msg.id, "url": msg.content.get("mediaSource"), "attempt": 0})
+
+
+    def recover(self):
+        msgs = Message.query.filter(Message.direction == 0).filter(Message.content["mediaPending"].as_boolean() == True).all()
+
+        for msg in msgs:
+            self.submit(msg)
+
+        if msgs:
+            debug_log.debug(f"[Media Downloads] Re-queued {len(msgs)} pending media download(s) from the database.")
+
+
+    def start(self):
+        self.recover()
+        self.queue.start()
+
+
+    def stats(self) -> dict:
+        return self.queue.stats()
+
+
+    def _handle_download(self, key: str, items: list) -> Union[float, None]:
+        item = items[0]
+        msg = Message.query.get(item["msg_id"])
+
+        if not (msg and msg.content.get("mediaPending")):
+            return None
+
+        stored_media = WhatsAppApiInterface.get_inbound_media(item["url"])
+
+        if stored_media:
+            content = {"mediaUrl": media_store.url(*stored_media)}
+
+            if msg.content.get("caption"):
+                content["caption"] = msg.content.get("caption")
+
+            msg.content = content
+
+        else:
+            item["attempt"] = item["attempt"] + 1
+
+            if item["attempt"] < AppConfig.WAAPI_MEDIA_FETCH_MAX_ATTEMPTS:
+                debug_log.debug(f"[Media Downloads] Media download attempt {item['attempt']} failed, retrying. [{msg.id}]")
+                return AppConfig.WAAPI_MEDIA_FETCH_RETRY_BASE_SEC * (2 ** (item["attempt"] - 1))
+
+            debug_log.debug(f"[Media Downloads] Giving up on media download after {item['attempt']} attempts. [{msg.id}]")
+            msg.content = {"text": MEDIA_DOWNLOAD_FAILURE_TEXT}
+            msg.type = MessageType.TEXT.name
+
+        msg.updated_at = datetime.now()
+        db.session.commit()
+
+        from modules.messaging import message_status_change
+        message_status_change(msg.client_number, "msg_media_ready", msg.id, msg)
+        return None
+
+
+media_downloader = DeferredMediaDownloader()
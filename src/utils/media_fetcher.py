@@ -0,0 +1,105 @@
+#  WhatsApp messaging client project
+#  Inbound WhatsApp media downloader
+
+
+# ------- Libraries and utils -------
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Union
+from config import AppConfig
+from init import debug_log
+from utils.media_store import media_store, media_extension
+
+
+# ------- Global variables -------
+CHUNK_SIZE = 64 * 1024
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Streams inbound media files straight to disk over a pooled keep-alive session ----
+class InboundMediaFetcher():
+    def __init__(self, workers: int, max_size_bytes: int, timeout: tuple):
+        self.workers = workers
+        self.max_size_bytes = max_size_bytes
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+        self.session.mount("http://", HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+
+        self._downloads = 0
+        self._failures = 0
+        self._too_large = 0
+        self._bytes = 0
+        self._total_latency = 0.0
+
+
+    def _record(self, success: bool, size: int, latency: float):
+        with self._lock:
+            if success:
+                self._downloads += 1
+                self._bytes += size
+                self._total_latency += latency
+
+            else:
+                self._failures += 1
+
+
+    # ---- Downloads one file into the media store, returns (digest, extension) ----
+    def fetch(self, media_url: str) -> Union[tuple, None]:
+        start = time.perf_counter()
+        size = 0
+
+        try:
+            with self.session.get(media_url, headers={"Authorization": f"App {AppConfig.WAAPI_API_KEY}"}, stream=True, timeout=self.timeout) as file:
+                if file.status_code != 200:
+                    debug_log.debug(f"[Media Fetcher] Unable to retrieve inbound media file. (Error {file.status_code}) [{media_url}]")
+                    self._record(False, 0, 0)
+                    return None
+
+                if int(file.headers.get("Content-Length") or 0) > self.max_size_bytes:
+                    raise OverflowError
+
+                def chunks():
+                    nonlocal size
+
+                    for chunk in file.iter_content(CHUNK_SIZE):
+                        size = size + len(chunk)
+
+                        if size > self.max_size_bytes:
+                            raise OverflowError
+
+                        yield chunk
+
+                stored = media_store.store_chunks(chunks(), media_extension(file.headers.get("Content-Type")))
+
+            latency = time.perf_counter() - start
+            self._record(True, size, latency)
+            debug_log.debug(f"[Media Fetcher] Successfully retrieved inbound media file. [{size} bytes, {round(latency * 1000)}ms] [{media_url}]")
+            return stored
+
+        except OverflowError:
+            self._too_large += 1
+            debug_log.debug(f"[Media Fetcher] Inbound media file is larger than the {self.max_size_bytes} byte limit. [{media_url}]")
+
+        except Exception:
+            debug_log.debug(f"[Media Fetcher] An exception occured whilst retrieving inbound media file. [{media_url}]", exc_info=1)
+
+        self._record(False, 0, 0)
+        return None
+
+
+    def stats(self) -> dict:
+        return {
+            "downloads": self._downloads,
+            "failures": self._failures,
+            "too_large": self._too_large,
+            "bytes": self._bytes,
+            "avg_latency_ms": round(self._total_latency * 1000 / self._downloads, 1) if self._downloads else 0.0
+        }
+
+
+media_fetcher = InboundMediaFetcher(AppConfig.WAAPI_MEDIA_FETCH_WORKERS, AppConfig.WAAPI_MEDIA_MAX_SIZE_MB * 1000 * 1000, (AppConfig.WAAPI_MEDIA_CONNECT_TIMEOUT_SEC, AppConfig.WAAPI_MEDIA_READ_TIMEOUT_SEC))
@@ -0,0 +1,208 @@
+#  WhatsApp messaging client project
+#  Content-addressed media file store
+
+
+# ------- Libraries and utils -------
+import os
+import re
+import uuid
+import hashlib
+import mimetypes
+from typing import Iterable, Union
+from config import AppConfig
+from datetime import datetime
+from flask import url_for
+from init import db, debug_log
+from modules.database import Message, StoredMedia
+from sqlalchemy import event, inspect, select, update, delete
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+
+# ------- Global variables -------
+MEDIA_URL_DIGEST_REGEX = re.compile(r"/media/([0-9a-f]{64})\.")
+MEDIA_EXTENSION_REGEX = re.compile(rf"[0-9a-z]{{1,{StoredMedia.extension.type.length}}}")  # Fits StoredMedia.extension
+SESSION_RELEASED_KEY = "media_store_released"
+
+# Content types mimetypes has no (or another) extension for, named as in FILE_MSG_TYPE_TABLE
+MEDIA_TYPE_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "audio/ogg": "ogg",
+    "audio/amr": "amr",
+    "video/3gpp": "3gpp"
+}
+
+
+# -=-=-= Functions =-=-=-
+def is_media_extension(extension: str) -> bool:
+    return bool(MEDIA_EXTENSION_REGEX.fullmatch(extension))
+
+
+# ---- File extension for a Content-Type header, "bin" when the header is missing or the type is unknown ----
+def media_extension(content_type: Union[str, None]) -> str:
+    mime_type = (content_type or "").split(";", 1)[0].strip().lower()  # e.g. "audio/ogg; codecs=opus"
+    extension = MEDIA_TYPE_EXTENSIONS.get(mime_type) or (mimetypes.guess_extension(mime_type) or "").lstrip(".")
+    return extension if is_media_extension(extension) else "bin"
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Stores media files by their SHA-256 digest with a reference count per file ----
+# The same content is only ever written to disk once. Files are served under
+# /media/<digest>.<ext>, their content can never change, so the URLs are cached as immutable.
+#
+# The reference count is the number of Message rows whose content points at the file. It
+# is kept by the Message mapper events below, inside the transaction that inserts, changes
+# or deletes the message, so every copy of a mediaUrl (redirects, outbox sends) is counted
+# and every deleted message releases exactly once. A file whose count dropped to 0 is
+# deleted after that transaction commits.
+class MediaStore():
+    def __init__(self, root_dir: str, temp_dir: str):
+        self.root_dir = root_dir
+        self.temp_dir = temp_dir
+
+
+    def file_dir(self, digest: str) -> str:
+        return os.path.join(self.root_dir, digest[:2])
+
+
+    def url(self, digest: str, extension: str) -> str:
+        return url_for("messaging.get_stored_media", digest=digest, ext=extension, _external=True, _scheme=AppConfig.HTTP_SCHEME)
+
+
+    def digest_from_url(self, url: str) -> Union[str, None]:
+        match = MEDIA_URL_DIGEST_REGEX.search(url or "")
+        return match.group(1) if match else None
+
+
+    # ---- Writes the chunks to the store and returns (digest, extension) ----
+    # Any exception raised while iterating over the chunks is passed on after the temporary file is removed.
+    def store_chunks(self, chunks: Iterable[bytes], extension: str) -> tuple:
+        os.makedirs(self.temp_dir, exist_ok=True)
+        temp_path = os.path.join(self.temp_dir, f"{uuid.uuid4()}.part")
+        digest = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(temp_path, "xb") as file:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size = size + len(chunk)
+                    file.write(chunk)
+
+            digest = digest.hexdigest()
+            extension = self._register(digest, extension.lower() if is_media_extension(extension.lower()) else "bin", size)
+            os.makedirs(self.file_dir(digest), exist_ok=True)
+            full_path = os.path.join(self.file_dir(digest), f"{digest}.{extension}")
+
+            if os.path.exists(full_path):
+                os.remove(temp_path)
+                debug_log.debug(f"[Media Store] File already stored, reusing it. [{digest}]")
+
+            else:
+                os.replace(temp_path, full_path)
+                debug_log.debug(f"[Media Store] Stored new file. [{digest}, {size} bytes]")
+
+            return (digest, extension)
+
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+
+    # ---- Creates the file's row (without any references) if needed, returns the extension the file is stored under ----
+    # Uses its own transaction, the caller's session is never committed.
+    def _register(self, digest: str, extension: str, size: int) -> str:
+        engine = db.engines[StoredMedia.__bind_key__]
+        dialect_insert = postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+
+        with engine.begin() as conn:
+            conn.execute(dialect_insert(StoredMedia).values(digest=digest, extension=extension, size=size, ref_count=0, created_at=datetime.now()).on_conflict_do_nothing(index_elements=["digest"]))
+            return conn.execute(select(StoredMedia.extension).where(StoredMedia.digest == digest)).scalar()
+
+
+    # ---- Adds to a file's reference count on the flushing connection ----
+    def _add_references(self, connection, digest: str, amount: int):
+        connection.execute(update(StoredMedia).where(StoredMedia.digest == digest).values(ref_count=StoredMedia.ref_count + amount))
+
+
+    # ---- Deletes the files that are no longer referenced, after the releasing transaction committed ----
+    def _delete_unreferenced(self, digests: set):
+        engine = db.engines[StoredMedia.__bind_key__]
+
+        for digest in digests:
+            with engine.begin() as conn:
+                # Conditional, a message that took a new reference in the meantime keeps the file
+                extension = conn.execute(delete(StoredMedia).where(StoredMedia.digest == digest).where(StoredMedia.ref_count <= 0).returning(StoredMedia.extension)).scalar()
+
+            if extension:
+                full_path = os.path.join(self.file_dir(digest), f"{digest}.{extension}")
+
+                if os.path.exists(full_path):
+                    os.remove(full_path)
+
+                debug_log.debug(f"[Media Store] Deleted file as it is no longer referenced. [{digest}]")
+
+
+    def message_digest(self, content: Union[dict, None]) -> Union[str, None]:
+        return self.digest_from_url((content or {}).get("mediaUrl"))
+
+
+    def _released(self, target: Message, connection, digest: str):
+        self._add_references(connection, digest, -1)
+        object_session(target).info.setdefault(SESSION_RELEASED_KEY, set()).add(digest)
+
+
+media_store = MediaStore(AppConfig.MEDIA_STORE_FOLDER, AppConfig.TEMPORARY_FILE_DIR)
+
+
+# -=-=-= Message events =-=-=-
+@event.listens_for(Message, "after_insert")
+def reference_message_media(mapper, connection, target: Message):
+    digest = media_store.message_digest(target.content)
+
+    if digest:
+        media_store._add_references(connection, digest, 1)
+
+
+@event.listens_for(Message, "after_update")
+def update_message_media(mapper, connection, target: Message):
+    history = inspect(target).attrs.content.history
+
+    if not history.deleted:
+        return
+
+    old_digest = media_store.message_digest(history.deleted[0])
+    new_digest = media_store.message_digest(target.content)
+
+    if old_digest != new_digest:
+        if new_digest:
+            media_store._add_references(connection, new_digest, 1)
+
+        if old_digest:
+            media_store._released(target, connection, old_digest)
+
+
+# Before the delete, so the content can still be loaded
+@event.listens_for(Message, "before_delete")
+def release_message_media(mapper, connection, target: Message):
+    digest = media_store.message_digest(target.content)
+
+    if digest:
+        media_store._released(target, connection, digest)
+
+
+# -=-=-= Session events =-=-=-
+@event.listens_for(Session, "after_commit")
+def delete_released_media(session: Session):
+    digests = session.info.pop(SESSION_RELEASED_KEY, None)
+
+    if digests:
+        media_store._delete_unreferenced(digests)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_released_media(session: Session):
+    session.info.pop(SESSION_RELEASED_KEY, None)
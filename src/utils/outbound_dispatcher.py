@@ -0,0 +1,209 @@
+#  WhatsApp messaging client project
+#  Rate limited outbound WhatsApp message dispatcher
+
+
+# ------- Libraries and utils -------
+import time
+import uuid
+import random
+import threading
+from collections import OrderedDict
+from typing import Union
+from config import AppConfig
+from datetime import datetime
+from init import db, log, debug_log
+from modules.database import OutboxMessage
+from utils.work_queue import KeyedWorkQueue
+from utils.whatsapp_interface import MessageType, MessageStatus, MessageSendError
+
+
+# ------- Global variables -------
+MAX_RECIPIENT_BUCKETS = 10000
+
+
+# -=-=-= Models =-=-=-
+# ---- Token bucket rate limiter ----
+class TokenBucket():
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    # ---- Takes a token if there is one, otherwise returns the number of seconds until there will be one ----
+    def try_acquire(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens = self._tokens - 1
+                return 0.0
+
+            return (1 - self._tokens) / self.rate
+
+
+    def refund(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Sends outgoing messages from the outbox table with a worker pool ----
+# Messages are written to the OutboxMessage table before anything is sent. The row's
+# message_id is used as the API messageId and as the Message.sid, and the Message is
+# recorded in the same commit that deletes the outbox row, so a crash at any point
+# leaves either a sent-and-recorded message or a pending row that recover() resends
+# under the same messageId on startup.
+#
+# Messages to the same number are sent in the order they were submitted, up to
+# OUTBOUND_QUEUE_MAX_BATCH_SIZE of them per batch, with one commit per sent message. A
+# message that is throttled (global or per-recipient token bucket) or fails stops its
+# batch, the rest of the lane is retried later, failures with a jittered exponential
+# backoff. A message that can not be sent is recorded as a FAILED Message.
+class OutboundDispatcher():
+    def __init__(self):
+        self.queue = KeyedWorkQueue("outbound_messages", self._handle_batch, AppConfig.OUTBOUND_QUEUE_WORKERS, AppConfig.OUTBOUND_QUEUE_MAX_BATCH_SIZE)
+        self.global_bucket = TokenBucket(AppConfig.OUTBOUND_GLOBAL_RATE_PER_SEC, AppConfig.OUTBOUND_GLOBAL_BURST)
+        self._recipient_buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._sent = 0
+        self._failed = 0
+        self._throttled = 0
+        self._send_time_total = 0.0
+
+
+    def submit(self, content: dict, type: MessageType, to_number: str, is_redirect: bool, origin_phone_number: Union[str, None]):
+        self.submit_many([(content, type, to_number, is_redirect, origin_phone_number)])
+
+
+    # ---- Writes (content, type, to_number, is_redirect, origin_phone_number) tuples to the outbox in one commit ----
+    def submit_many(self, messages: list[tuple]):
+        now = datetime.now()
+        rows = []
+
+        for content, type, to_number, is_redirect, origin_phone_number in messages:
+            rows.append(OutboxMessage(message_id=str(uuid.uuid4()), to_number=to_number, type=type.name, content=dict(content), is_redirect=is_redirect, origin_phone_number=origin_phone_number, attempts=0, created_at=now))
+
+        db.session.add_all(rows)
+        db.session.flush()
+        queued = [(row.to_number, row.id) for row in rows]  # Read before the commit expires the rows
+        db.session.commit()
+
+        for to_number, id in queued:
+            self.queue.submit(to_number, id)
+
+
+    def recover(self):
+        rows = OutboxMessage.query.order_by(OutboxMessage.id).all()
+
+        for row in rows:
+            self.queue.submit(row.to_number, row.id, row.created_at.timestamp())
+
+        if rows:
+            debug_log.debug(f"[Outbound Dispatcher] Re-queued {len(rows)} unsent outbox message(s) from the database.")
+
+
+    def start(self):
+        self.recover()
+        self.queue.start()
+
+
+    def stats(self) -> dict:
+        stats = self.queue.stats()
+        stats.update({
+            "outbox_rows": OutboxMessage.query.count(),
+            "sent": self._sent,
+            "send_failures": self._failed,
+            "throttle_events": self._throttled,
+            "avg_send_latency_ms": round(self._send_time_total * 1000 / self._sent, 1) if self._sent else 0.0
+        })
+
+        return stats
+
+
+    def _recipient_bucket(self, to_number: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._recipient_buckets.get(to_number)
+
+            if not bucket:
+                bucket = TokenBucket(AppConfig.OUTBOUND_RECIPIENT_RATE_PER_SEC, AppConfig.OUTBOUND_RECIPIENT_BURST)
+                self._recipient_buckets[to_number] = bucket
+
+                if len(self._recipient_buckets) > MAX_RECIPIENT_BUCKETS:
+                    self._recipient_buckets.popitem(last=False)
+
+            self._recipient_buckets.move_to_end(to_number)
+            return bucket
+
+
+    def _acquire(self, to_number: str) -> float:
+        recipient_bucket = self._recipient_bucket(to_number)
+        wait = recipient_bucket.try_acquire()
+
+        if wait == 0:
+            wait = self.global_bucket.try_acquire()
+
+            if wait > 0:
+                recipient_bucket.refund()
+
+        if wait > 0:
+            self._throttled += 1
+
+        return wait
+
+
+    def _handle_batch(self, to_number: str, ids: list) -> Union[float, None]:
+        from utils.whatsapp import WhatsApp
+        from modules.messaging import message_status_change, msg_redirect_status_resp
+
+        # Rows already sent by an earlier run of this batch are gone, so a retried batch never sends twice
+        rows = OutboxMessage.query.filter(OutboxMessage.id.in_(ids)).order_by(OutboxMessage.id).all()
+
+        for row in rows:
+            wait = self._acquire(to_number)
+
+            if wait > 0:
+                return wait
+
+            start = time.perf_counter()
+
+            try:
+                msg = WhatsApp.send_outbox_message(row)
+
+            except MessageSendError as error:
+                row.attempts = row.attempts + 1
+
+                if error.retryable and row.attempts < AppConfig.OUTBOUND_MAX_ATTEMPTS:
+                    retry_delay = AppConfig.OUTBOUND_RETRY_BASE_SEC * (2 ** (row.attempts - 1)) * random.uniform(0.5, 1.5)
+                    db.session.commit()
+                    debug_log.debug(f"[Outbound Dispatcher] Send attempt {row.attempts} to [{to_number}] failed, retrying in {round(retry_delay, 2)}s.")
+                    return retry_delay
+
+                self._failed += 1
+                log.error(f"[Outbound Dispatcher] Giving up on sending a message to [{to_number}] after {row.attempts} attempt(s). [{row.message_id}, {error}]")
+
+                msg = WhatsApp.outbox_message_record(row)
+                msg.status = MessageStatus.FAILED.name
+                db.session.add(msg)
+
+            else:
+                self._sent += 1
+                self._send_time_total += time.perf_counter() - start
+
+            # The Message is recorded in the same transaction that removes the row from the outbox
+            db.session.delete(row)
+            db.session.commit()
+            message_status_change(to_number, "msg_sent", msg.id, msg)
+
+            if msg.status == MessageStatus.FAILED.name:
+                msg_redirect_status_resp(msg, MessageStatus.FAILED)
+
+        return None
+
+
+outbound_dispatcher = OutboundDispatcher()
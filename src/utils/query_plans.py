@@ -0,0 +1,79 @@
+#  WhatsApp messaging client project
+#  Query plan check for the hot queries
+
+
+# ------- Libraries and utils -------
+from datetime import datetime
+from sqlalchemy.exc import OperationalError
+from init import db, debug_log
+from modules.database import Agent, PhoneNumber, RedirectRule
+
+
+# -=-=-= Exceptions =-=-=-
+class QueryPlanError(Exception):
+    pass
+
+
+# -=-=-= Functions =-=-=-
+# ---- (bind key, name, query) for the queries that run on every page load, API call or webhook ----
+# Built with the same query functions and filters the routes use, only the values are placeholders.
+def hot_queries() -> list[tuple]:
+    from modules.messaging import message_page_query, new_messages_query, updated_messages_query
+    
+    cursor = (datetime.now(), 0)
+    
+    return [
+        ("messages", "message_page", message_page_query("")),
+        ("messages", "message_page_before", message_page_query("", before=cursor)),
+        ("messages", "message_page_after", message_page_query("", after=cursor)),
+        ("messages", "new_messages", new_messages_query("", 0)),
+        ("messages", "updated_messages", updated_messages_query("", datetime.now(), 0)),
+        ("messages", "phone_number_by_number", PhoneNumber.query.filter_by(number="")),
+        ("messages", "phone_number_by_customer_id", PhoneNumber.query.filter_by(customer_id="")),
+        ("agents", "redirect_rules_by_phone_number", RedirectRule.query.filter_by(phone_number="")),
+        ("agents", "redirect_rule_by_phone_number_and_agent", RedirectRule.query.filter_by(phone_number="").filter_by(agent_id=0)),
+        ("agents", "redirect_rules_by_agent", RedirectRule.query.filter_by(agent_id=0)),
+        ("agents", "agent_by_fs_user", Agent.query.filter_by(type="fs_user").filter_by(fs_user_id=0)),
+        ("agents", "agent_by_phone_number", Agent.query.filter_by(phone_number=""))
+    ]
+
+
+# ---- Compiles the query for the bind's dialect and runs EXPLAIN QUERY PLAN on it (SQLite only) ----
+def explain(bind_key: str, query) -> list[str]:
+    engine = db.engines[bind_key]
+    compiled = query.statement.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+    
+    # The plan does not depend on the values, so every parameter is bound to NULL
+    with engine.connect() as conn:
+        return [row[-1] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), (None,) * len(compiled.positiontup))]
+
+
+# ---- Plans of every hot query, a query that scans a whole table (or index) is flagged ----
+def explain_hot_queries() -> dict:
+    plans = {}
+    
+    for bind_key, name, query in hot_queries():
+        if db.engines[bind_key].dialect.name != "sqlite":
+            plans[name] = {"plan": None, "table_scan": None}
+            continue
+        
+        plan = explain(bind_key, query)
+        plans[name] = {"plan": plan, "table_scan": any(step.startswith("SCAN") for step in plan)}
+    
+    return plans
+
+
+# ---- Raises QueryPlanError if any hot query scans a whole table, run at startup in debug mode ----
+def check_query_plans():
+    try:
+        plans = explain_hot_queries()
+    
+    except OperationalError as e:
+        raise QueryPlanError("Hot queries use columns the database does not have, run \"flask db upgrade\".") from e
+    
+    scans = [f"{name}: {plan['plan']}" for name, plan in plans.items() if plan["table_scan"]]
+    
+    if scans:
+        raise QueryPlanError("Hot queries without a usable index, run \"flask db upgrade\": " + "; ".join(scans))
+    
+    debug_log.debug(f"[Query Plans] All {len(plans)} hot queries use an index.")
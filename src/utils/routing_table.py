@@ -0,0 +1,136 @@
+#  WhatsApp messaging client project
+#  In-memory redirect rule and agent routing table
+
+
+# ------- Libraries and utils -------
+import threading
+from dataclasses import dataclass
+from typing import Union
+from init import db, debug_log
+from modules.database import Agent, RedirectRule
+
+
+# -=-=-= Models =-=-=-
+# ---- Detached copy of an agent row, safe to share between requests and workers ----
+@dataclass(frozen=True)
+class AgentEntry():
+    id: int
+    name: str
+    type: str
+    phone_number: Union[str, None]
+    fs_user_id: Union[int, None]
+
+
+@dataclass(frozen=True)
+class CompiledRoutes():
+    agents_by_id: dict
+    agents_by_number: dict
+    agents_by_fs_user: dict
+    customer_agents: dict
+    agent_customers: dict
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Redirect rules and agents compiled into lookup tables ----
+# The table is built from the agents database with two queries the first time it is
+# needed and kept until invalidate() is called. Anything that adds, changes or deletes
+# an Agent or RedirectRule must call invalidate() after committing.
+class RoutingTable():
+    def __init__(self):
+        self._routes = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+        self._builds = 0
+        self._invalidations = 0
+
+
+    def invalidate(self):
+        with self._lock:
+            self._routes = None
+            self._version += 1
+            self._invalidations += 1
+
+
+    def _compile(self) -> CompiledRoutes:
+        with self._lock:
+            if self._routes:
+                return self._routes
+
+            version = self._version
+
+        agents = [AgentEntry(agent.id, agent.name, agent.type, agent.phone_number, agent.fs_user_id) for agent in db.session.query(Agent).all()]
+        rules = db.session.query(RedirectRule.phone_number, RedirectRule.agent_id).order_by(RedirectRule.id).all()
+
+        agents_by_id = {agent.id: agent for agent in agents}
+        customer_agents = {}
+        agent_customers = {}
+
+        for rule in rules:
+            agent = agents_by_id.get(rule.agent_id)
+
+            if agent:
+                customer_agents.setdefault(rule.phone_number, []).append(agent)
+                agent_customers.setdefault(agent.id, []).append(rule.phone_number)
+
+        routes = CompiledRoutes(agents_by_id=agents_by_id,
+                                agents_by_number={agent.phone_number: agent for agent in agents if agent.phone_number},
+                                agents_by_fs_user={agent.fs_user_id: agent for agent in agents if agent.fs_user_id is not None},
+                                customer_agents={number: tuple(entries) for number, entries in customer_agents.items()},
+                                agent_customers={id: tuple(numbers) for id, numbers in agent_customers.items()})
+
+        with self._lock:
+            self._builds += 1
+
+            # Only keep the result if nothing was invalidated while it was being built
+            if version == self._version:
+                self._routes = routes
+
+        debug_log.debug(f"[Routing Table] Compiled {len(agents)} agent(s) and {len(rules)} redirect rule(s).")
+        return routes
+
+
+    # ---- Changes every time the table is invalidated, for caches derived from it ----
+    @property
+    def version(self) -> int:
+        return self._version
+
+
+    def agents_for_customer(self, phone_number: str) -> tuple:
+        return self._compile().customer_agents.get(phone_number, ())
+
+
+    def customers_for_agent(self, agent_id: int) -> tuple:
+        return self._compile().agent_customers.get(agent_id, ())
+
+
+    def agent(self, agent_id: int) -> Union[AgentEntry, None]:
+        return self._compile().agents_by_id.get(agent_id)
+
+
+    def agent_by_number(self, phone_number: str) -> Union[AgentEntry, None]:
+        return self._compile().agents_by_number.get(phone_number)
+
+
+    def agent_by_fs_user(self, user_id: int) -> Union[AgentEntry, None]:
+        return self._compile().agents_by_fs_user.get(user_id)
+
+
+    # ---- Phone numbers that belong to agents rather than customers ----
+    def agent_numbers(self) -> tuple:
+        return tuple(self._compile().agents_by_number)
+
+
+    def stats(self) -> dict:
+        routes = self._routes
+
+        return {
+            "compiled": routes is not None,
+            "agents": len(routes.agents_by_id) if routes else 0,
+            "customers": len(routes.customer_agents) if routes else 0,
+            "builds": self._builds,
+            "invalidations": self._invalidations
+        }
+
+
+routing_table = RoutingTable()
@@ -0,0 +1,80 @@
+#  WhatsApp messaging client project
+#  Recently seen message SID filter
+
+
+# ------- Libraries and utils -------
+import threading
+from collections import OrderedDict
+from config import AppConfig
+from init import db, debug_log
+from modules.database import Message
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Bounded LRU set of recently seen inbound message SIDs ----
+# A SID that is not in the set is treated as new and inserted without a lookup,
+# the unique index on Message.sid still catches duplicates older than the set.
+# Only SIDs that are in the set (possible duplicates) are checked against the database.
+class RecentSidFilter():
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._sids = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._lookups = 0
+        self._possible_hits = 0
+        self._confirmed_duplicates = 0
+        self._index_fallbacks = 0
+
+
+    def seed(self):
+        rows = db.session.query(Message.sid).order_by(Message.id.desc()).limit(self.capacity).all()
+
+        for row in reversed(rows):
+            self.add(row.sid)
+
+        debug_log.debug(f"[SID Filter] Seeded filter with {len(rows)} SID(s).")
+
+
+    def add(self, sid: str):
+        with self._lock:
+            self._sids[sid] = True
+            self._sids.move_to_end(sid)
+
+            while len(self._sids) > self.capacity:
+                self._sids.popitem(last=False)
+
+
+    def might_contain(self, sid: str) -> bool:
+        with self._lock:
+            self._lookups += 1
+
+            if sid in self._sids:
+                self._possible_hits += 1
+                return True
+
+            return False
+
+
+    def record_duplicates(self, count: int):
+        self._confirmed_duplicates += count
+
+
+    # ---- Called when the unique index caught a duplicate that the filter missed ----
+    def record_index_fallback(self):
+        self._index_fallbacks += 1
+
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._sids),
+            "capacity": self.capacity,
+            "lookups": self._lookups,
+            "possible_hits": self._possible_hits,
+            "confirmed_duplicates": self._confirmed_duplicates,
+            "index_fallbacks": self._index_fallbacks,
+            "hit_rate": round(self._possible_hits / self._lookups, 4) if self._lookups else 0.0
+        }
+
+
+sid_filter = RecentSidFilter(AppConfig.INBOUND_SID_FILTER_SIZE)
@@ -0,0 +1,132 @@
+#  WhatsApp messaging client project
+#  SQLite engine tuning profile
+
+
+# ------- Libraries and utils -------
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from typing import Union
+from config import AppConfig
+
+
+# ------- Global variables -------
+# Applied first so that switching the journal mode waits for other connections
+PRAGMA_ORDER = ["busy_timeout", "journal_mode", "synchronous", "cache_size", "mmap_size"]
+
+
+# -=-=-= Functions =-=-=-
+# ---- Gets the pragmas for a bind, the bind profile overrides the default profile ----
+def sqlite_pragmas(bind_key: Union[str, None]) -> dict:
+    pragmas = dict(AppConfig.SQLITE_ENGINE_PROFILE)
+    pragmas.update(AppConfig.SQLITE_BIND_PROFILES.get(bind_key, {}))
+    return pragmas
+
+
+def apply_pragmas(dbapi_connection, pragmas: dict):
+    cursor = dbapi_connection.cursor()
+
+    for pragma in sorted(pragmas, key=lambda name: PRAGMA_ORDER.index(name) if name in PRAGMA_ORDER else len(PRAGMA_ORDER)):
+        cursor.execute(f"PRAGMA {pragma} = {pragmas[pragma]}")
+
+    cursor.close()
+
+
+def attach_databases(dbapi_connection, attached: dict):
+    cursor = dbapi_connection.cursor()
+
+    for schema, path in attached.items():
+        cursor.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+
+    cursor.close()
+
+
+# ---- Applies the bind's pragmas to every new connection of a SQLite engine and ATTACHes {schema: path} ----
+def register_sqlite_profile(engine: Engine, bind_key: Union[str, None], attached: Union[dict, None] = None):
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = sqlite_pragmas(bind_key)
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
+
+        if attached:
+            attach_databases(dbapi_connection, attached)
+
+
+# ---- Concurrent read/write benchmark, run once without pragmas and once with the given ones ----
+# Uses plain sqlite3 connections on a temporary database so it can run outside of the app
+# (and outside of gevent, which would serialize the threads). Connections are opened with
+# timeout=0, so the only busy timeout is the one in the pragmas (sqlite3 waits 5s by default).
+def benchmark(pragmas: dict, writers: int = 4, readers: int = 4, duration: float = 3.0) -> dict:
+    results = {}
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        for name, profile in [("default", {}), ("tuned", pragmas)]:
+            path = os.path.join(temp_dir, f"{name}.sqlite3")
+            counts = {"writes": 0, "reads": 0, "locked_errors": 0}
+            lock = threading.Lock()
+            stop_at = time.monotonic() + duration
+
+            conn = sqlite3.connect(path, timeout=0)
+            apply_pragmas(conn, profile)
+            conn.execute("CREATE TABLE message (id INTEGER PRIMARY KEY, client_number TEXT, content TEXT)")
+            conn.commit()
+            conn.close()
+
+            def work(write: bool):
+                conn = sqlite3.connect(path, timeout=0)
+                apply_pragmas(conn, profile)
+
+                while time.monotonic() < stop_at:
+                    try:
+                        if write:
+                            conn.execute("INSERT INTO message (client_number, content) VALUES (?, ?)", ("+905555555555", "benchmark"))
+                            conn.commit()
+
+                        else:
+                            conn.execute("SELECT COUNT(*) FROM message WHERE client_number = ?", ("+905555555555",)).fetchone()
+
+                        with lock:
+                            counts["writes" if write else "reads"] += 1
+
+                    except sqlite3.OperationalError:
+                        conn.rollback()
+
+                        with lock:
+                            counts["locked_errors"] += 1
+
+                conn.close()
+
+            threads = [threading.Thread(target=work, args=(True,)) for i in range(writers)] + [threading.Thread(target=work, args=(False,)) for i in range(readers)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            counts["writes_per_sec"] = round(counts["writes"] / duration, 1)
+            counts["reads_per_sec"] = round(counts["reads"] / duration, 1)
+            counts["pragmas"] = profile
+            results[name] = counts
+
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return results
+
+
+# ------- Running the benchmark -------
+if __name__ == "__main__":
+    from init import log
+    log.info(f"[SQLite Profile] Benchmark results (sqlite3 timeout=0): {json.dumps(benchmark(sqlite_pragmas('messages')))}")
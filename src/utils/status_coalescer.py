@@ -0,0 +1,83 @@
+#  WhatsApp messaging client project
+#  Message status update coalescing utility
+
+
+# ------- Libraries and utils -------
+import threading
+from typing import Union
+from datetime import datetime
+from config import AppConfig
+from utils.whatsapp_interface import MessageStatus, StandardMessageObject
+
+
+# ------- Global variables -------
+# A status may only replace another status with a lower precedence
+STATUS_PRECEDENCE = {
+    MessageStatus.PENDING: 0,
+    MessageStatus.SENT: 1,
+    MessageStatus.DELIVERED: 2,
+    MessageStatus.READ: 3,
+    MessageStatus.FAILED: 4
+}
+
+
+# -=-=-= Functions =-=-=-
+def is_status_advance(current: Union[MessageStatus, None], new: MessageStatus) -> bool:
+    if current is None:
+        return True
+
+    return STATUS_PRECEDENCE[new] > STATUS_PRECEDENCE[current]
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Keeps only the latest status per SID out of a batch of status updates ----
+# Coalescing happens on the inbound queue's batches, whose InboundCallback rows are only
+# deleted after the coalesced write has been committed. A batch of status updates that
+# is younger than the window is held back (see hold_back()) so that more updates for the
+# same customer can join it.
+class StatusCoalescer():
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = threading.Lock()
+
+        self._received = 0
+        self._applied = 0
+        self._unmatched = 0
+
+
+    def coalesce(self, results: list[StandardMessageObject]) -> dict:
+        statuses = {}
+
+        for result in results:
+            if result.status and is_status_advance(statuses.get(result.message_id), result.status):
+                statuses[result.message_id] = result.status
+
+        with self._lock:
+            self._received += len([result for result in results if result.status])
+
+        return statuses
+
+
+    # ---- Seconds to hold back a batch of status updates that was received at oldest_received_at ----
+    def hold_back(self, oldest_received_at: datetime) -> Union[float, None]:
+        remaining = self.window - (datetime.now() - oldest_received_at).total_seconds()
+        return remaining if remaining > 0 else None
+
+
+    def record_applied(self, applied: int, unmatched: int):
+        with self._lock:
+            self._applied += applied
+            self._unmatched += unmatched
+
+
+    def stats(self) -> dict:
+        return {
+            "window_seconds": self.window,
+            "received": self._received,
+            "applied": self._applied,
+            "unmatched": self._unmatched,
+            "coalesced": self._received - self._applied - self._unmatched
+        }
+
+
+status_coalescer = StatusCoalescer(AppConfig.WAAPI_STATUS_COALESCE_WINDOW_SEC)
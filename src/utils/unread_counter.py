@@ -0,0 +1,94 @@
+#  WhatsApp messaging client project
+#  Unread message counter utility
+
+
+# ------- Libraries and utils -------
+import threading
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+from init import db
+from modules.database import PhoneNumber
+
+
+# ------- Global variables -------
+SESSION_DELTA_KEY = "unread_counter_delta"
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Atomic per-customer unread counters and an in-memory total of all of them ----
+# Counters are only changed with UPDATE ... SET unread_msgs = unread_msgs + n, never with
+# read-modify-write in Python. The change to the total is kept on the session and only
+# applied once the session commits, a rollback discards it. The total is loaded with a
+# single SUM() the first time it is needed and after invalidate().
+class UnreadCounter():
+    def __init__(self):
+        self._total = None
+        self._lock = threading.Lock()
+
+
+    # ---- Adds to a customer's counter in the current session, the caller commits ----
+    def add(self, phone_number: str, amount: int):
+        PhoneNumber.query.filter_by(number=phone_number).update({PhoneNumber.unread_msgs: PhoneNumber.unread_msgs + amount}, synchronize_session=False)
+        self.record_new(amount)
+
+
+    # ---- Records unread messages on a PhoneNumber row that was just added to the session ----
+    def record_new(self, amount: int):
+        db.session.info[SESSION_DELTA_KEY] = db.session.info.get(SESSION_DELTA_KEY, 0) + amount
+
+
+    # ---- Sets a customer's counter to 0 and commits, returns whether there was anything to reset ----
+    # Only the messages that were counted when it was read are subtracted, so a message
+    # that arrives in the meantime stays unread instead of being lost.
+    def reset(self, phone_number: str) -> bool:
+        unread = db.session.query(PhoneNumber.unread_msgs).filter_by(number=phone_number).scalar()
+
+        if unread:
+            self.add(phone_number, -unread)
+            db.session.commit()
+            return True
+
+        return False
+
+
+    def total(self) -> int:
+        with self._lock:
+            if self._total is not None:
+                return self._total
+
+        total = int(db.session.query(func.coalesce(func.sum(PhoneNumber.unread_msgs), 0)).scalar())
+
+        with self._lock:
+            if self._total is None:
+                self._total = total
+
+            return self._total
+
+
+    # ---- Drops the in-memory total, for changes made without add() (e.g. the developer console) ----
+    def invalidate(self):
+        with self._lock:
+            self._total = None
+
+
+    def _apply(self, delta: int):
+        with self._lock:
+            if self._total is not None:
+                self._total = self._total + delta
+
+
+unread_counter = UnreadCounter()
+
+
+# -=-=-= Session events =-=-=-
+@event.listens_for(Session, "after_commit")
+def apply_unread_delta(session: Session):
+    delta = session.info.pop(SESSION_DELTA_KEY, 0)
+
+    if delta:
+        unread_counter._apply(delta)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_unread_delta(session: Session):
+    session.info.pop(SESSION_DELTA_KEY, None)
@@ -12,202 +12,283 @@ import os
 from init import log, debug_log, db
 from typing import Union
 from config import AppConfig
-from flask import abort, url_for
-from modules.database import Message, RedirectRule, Agent, PhoneNumber, AnnouncementMessage
+from flask import url_for
+from modules.database import Message, PhoneNumber, AnnouncementMessage, OutboxMessage, CustomerIdSequence
 from datetime import datetime
-from utils.whatsapp_interface import WhatsAppApiInterface, StandardMessageObject, MessageType
-from utils.global_helpers import save_binary_file
-from msg_dsp_text import SYSTEM_ANNOUNCEMENT_MESSAGES
+from utils.whatsapp_interface import WhatsAppApiInterface, StandardMessageObject, MessageType, MessageStatus
+from utils.sid_filter import sid_filter
+from utils.media_downloads import media_downloader, pending_media_content
+from utils.status_coalescer import status_coalescer, is_status_advance
+from utils.outbound_dispatcher import outbound_dispatcher
+from utils.routing_table import routing_table
+from utils.unread_counter import unread_counter
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from msg_dsp_text import SYSTEM_ANNOUNCEMENT_MESSAGES, WA_SYSTEM_RESPONSES
+from utils.announcements import announcement_cache
+
+
+# ------- Global variables -------
+MEDIA_MESSAGE_TYPES = ["document", "image", "audio", "voice", "video", "sticker"]
+
+
+# -=-=-= Exceptions =-=-=-
+# ---- MAX_CUSTOMERS_PER_DAY was reached, a message from a new customer can not be stored until tomorrow ----
+class CustomerLimitReached(Exception):
+    pass
 
 
 # -=-=-= Functions =-=-=-
 def get_agents_responsible(phone_number: str) -> list:
-    redirect_rules = db.session.query(RedirectRule).filter_by(phone_number=phone_number).all()
-    agents_resp = []
-            
-    if redirect_rules:
-        for rule in redirect_rules:
-            agent = db.session.query(Agent).filter_by(id=rule.agent_id).first()
-                    
-            if agent:
-                agents_resp.append(agent.name)
-                
-    return agents_resp
+    return [agent.name for agent in routing_table.agents_for_customer(phone_number)]
 
 
+# ---- Creates the sequence row for a day, starting after the highest customer ID already given out that day ----
+def seed_customer_id_sequence(date_formatted: str):
+    prefix = AppConfig.CUSTOMER_ID_FORMAT.format(date=date_formatted, day_id="")
+    customer_ids = db.session.query(PhoneNumber.customer_id).filter(PhoneNumber.customer_id.like(prefix + "%")).all()
+    highest_number = max([int(row.customer_id.split("-")[2]) for row in customer_ids], default=0)
+    
+    dialect_insert = postgresql_insert if db.session.get_bind(CustomerIdSequence).dialect.name == "postgresql" else sqlite_insert
+    db.session.execute(dialect_insert(CustomerIdSequence).values(day=date_formatted, last_value=highest_number).on_conflict_do_nothing(index_elements=["day"]))
+    
+    # A new day, the limit reached announcement from a previous day no longer applies
+    AnnouncementMessage.query.filter_by(message=str(SYSTEM_ANNOUNCEMENT_MESSAGES.CUSTOMERS_PER_DAY_LIMIT_REACHED)).delete(synchronize_session=False)
+    announcement_cache.invalidate_on_commit()
+
+
+# ---- Hands out the next customer ID of the day in one atomic UPDATE, as part of the caller's transaction ----
+# Rolls the caller's transaction back and raises CustomerLimitReached if there are no IDs left for today.
 def generate_customer_id() -> str:
-    time = datetime.now()
-    date_formatted = time.strftime("%d%m%Y")
-    phone_numbers = PhoneNumber.query.all()
-    highest_number = 0
+    date_formatted = datetime.now().strftime("%d%m%Y")
     
-    for i in range(20):
-        for number in phone_numbers:
-            cid_split = number.customer_id.split("-")
-            
-            if cid_split[1] == date_formatted:
-                if int(cid_split[2]) > highest_number:
-                    highest_number = int(cid_split[2])
-                    
-        msg_to_db = AnnouncementMessage(message=str(SYSTEM_ANNOUNCEMENT_MESSAGES.CUSTOMERS_PER_DAY_LIMIT_REACHED), level="danger", start_time=datetime.now(), duration="inf")
-        msg_query = AnnouncementMessage.query.filter_by(message=msg_to_db.message).first()
-              
-        if highest_number >= AppConfig.MAX_CUSTOMERS_PER_DAY:
-            if not msg_query:
-                db.session.add(msg_to_db)
-                db.session.commit()
-            
-            log.warning("Maximum number of customers per day reached! Please contact system administrator!")
-            abort(423)
-            
-        if msg_query:
-            db.session.delete(msg_query)
-            db.session.commit()
-                
-        cid = AppConfig.CUSTOMER_ID_FORMAT.format(date=date_formatted, day_id=int(highest_number) + 1)
-        query = PhoneNumber.query.filter_by(customer_id=cid).first()
+    for i in range(2):
+        day_id = db.session.execute(update(CustomerIdSequence)
+                                    .where(CustomerIdSequence.day == date_formatted)
+                                    .where(CustomerIdSequence.last_value < AppConfig.MAX_CUSTOMERS_PER_DAY)
+                                    .values(last_value=CustomerIdSequence.last_value + 1)
+                                    .returning(CustomerIdSequence.last_value)).scalar()
         
-        if not query:
-            return cid
+        if day_id:
+            return AppConfig.CUSTOMER_ID_FORMAT.format(date=date_formatted, day_id=day_id)
         
-    abort(500)
+        if db.session.query(CustomerIdSequence.id).filter_by(day=date_formatted).first():
+            break
+        
+        seed_customer_id_sequence(date_formatted)
+    
+    # Nothing from the caller's transaction can be kept, the customer can not be created
+    db.session.rollback()
+    msg_to_db = AnnouncementMessage(message=str(SYSTEM_ANNOUNCEMENT_MESSAGES.CUSTOMERS_PER_DAY_LIMIT_REACHED), level="danger", start_time=datetime.now(), duration="inf")
+    
+    if not AnnouncementMessage.query.filter_by(message=msg_to_db.message).first():
+        db.session.add(msg_to_db)
+        db.session.commit()
+        announcement_cache.invalidate()
+    
+    log.warning("Maximum number of customers per day reached! Please contact system administrator!")
+    raise CustomerLimitReached()
 
 
 # -=-=-= Main utility object =-=-=-
 class WhatsApp():
-    def send_freeform_message(content: dict, type: MessageType, to_number: str, is_redirect: bool, origin_phone_number: Union[str, None]) -> Union[any, None]:
-        try:
-            agents_resp = get_agents_responsible(to_number)
-            agents_resp_dict = {}
+    # ---- Writes the message to the outbox, it is sent in the background by the outbound dispatcher ----
+    def send_freeform_message(content: dict, type: MessageType, to_number: str, is_redirect: bool, origin_phone_number: Union[str, None]):
+        outbound_dispatcher.submit(content, type, to_number, is_redirect, origin_phone_number)
+        debug_log.debug(f"[WhatsApp API] Queued freeform WhatsApp message to [{to_number}].")
+
+
+    # ---- Same as send_freeform_message() for a list of argument tuples, written to the outbox in one commit ----
+    def send_freeform_messages(messages: list[tuple]):
+        outbound_dispatcher.submit_many(messages)
+        debug_log.debug(f"[WhatsApp API] Queued {len(messages)} freeform WhatsApp message(s) to {list(dict.fromkeys(message[2] for message in messages))}.")
+
+
+    # ---- Builds the Message that records an outbox row (not added to the session) ----
+    def outbox_message_record(row: OutboxMessage) -> Message:
+        agents_resp = get_agents_responsible(row.to_number)
+        agents_resp_dict = {}
+        
+        for id, agent in enumerate(agents_resp):
+            agents_resp_dict.update({id: agent})
             
-            for id, agent in enumerate(agents_resp):
-                agents_resp_dict.update({id: agent})
-                
-            now = datetime.now()
-                
-            message = WhatsAppApiInterface.send_freeform_message(StandardMessageObject(None, type, content, None, to_number, None, None))
-            msg = Message(sid=message.message_id, direction=1, client_number=to_number, agents_resp=agents_resp_dict, origin_phone_number=origin_phone_number, datetime=now, status=message.status.name, content=content, type=type.name, is_redirect=is_redirect)
+        return Message(sid=row.message_id, direction=1, client_number=row.to_number, agents_resp=agents_resp_dict, origin_phone_number=row.origin_phone_number, datetime=datetime.now(), content=row.content, type=row.type, is_redirect=row.is_redirect)
+    
+    
+    # ---- Sends an outbox row and returns the Message to record for it (added to the session, not committed) ----
+    # Raises MessageSendError if the API did not accept the message. Everything that can fail
+    # otherwise is done before the API call, so a message that was sent is never sent again.
+    def send_outbox_message(row: OutboxMessage) -> Message:
+        msg = WhatsApp.outbox_message_record(row)
+        message = WhatsAppApiInterface.send_freeform_message(StandardMessageObject(row.message_id, MessageType.from_str(row.type), row.content, None, row.to_number, None, None))
+        msg.status = message.status.name if message.status else None
+        db.session.add(msg)
+        
+        debug_log.debug(f"[WhatsApp API] Sent freeform WhatsApp message to [{row.to_number}] successfully.")
+        return msg
+    
+
+    # ---- Coalesces and applies a batch of status updates, returns the SIDs that have no message (yet) ----
+    def handle_message_status_call(results: list[StandardMessageObject]) -> set:
+        return WhatsApp.apply_status_updates(status_coalescer.coalesce(results))
+    
+    
+    def apply_status_updates(statuses: dict) -> set:
+        msgs = Message.query.filter(Message.sid.in_(statuses.keys())).all()
+        unmatched = set(statuses.keys()) - {msg.sid for msg in msgs}
+        updated = []
+        now = datetime.now()
+        
+        for msg in msgs:
+            status = statuses[msg.sid]
+            current_status = MessageStatus.from_str(msg.status) if msg.status else None
             
-            db.session.add(msg)
+            if is_status_advance(current_status, status):
+                msg.status = status.name
+                msg.updated_at = now
+                updated.append((msg, status))
+                
+            else:
+                debug_log.debug(f"[WhatsApp API] Ignored status update as it would regress the message status. [{msg.status} -> {status.name}]")
+        
+        status_coalescer.record_applied(len(msgs), len(unmatched))
+        
+        if unmatched:
+            debug_log.debug(f"[WhatsApp API] Received status update(s) for message(s) that do not exist (yet), they will be retried. {list(unmatched)}")
+        
+        if updated:
+            updated_ids = {msg.id for msg, status in updated}
             db.session.commit()
+            debug_log.debug(f"[WhatsApp API] Wrote {len(updated)} coalesced status update(s) to database successfuly.")
             
-            debug_log.debug(f"[WhatsApp API] Sent freeform WhatsApp message to [{to_number}] successfully.")
-            
-            msg = Message.query.filter_by(sid=message.message_id).first()
-            from modules.messaging import message_status_change
-            message_status_change(to_number, "msg_sent", msg.id, msg)
+            # Reloads every updated message in one query after the commit expired them
+            Message.query.filter(Message.id.in_(updated_ids)).all()
             
-            return message
+            from modules.messaging import message_status_change, msg_redirect_status_resp
             
-        except Exception:
-            debug_log.debug(f"[WhatsApp API] An exception occured whilst trying to send a freeform WhatsApp message to [{to_number}]:", exc_info=1)
-            log.error(f"[WhatsApp API] An exception occured whilst trying to send a freeform WhatsApp message to [{to_number}]:", exc_info=1)
-            return None
+            for msg, status in updated:
+                message_status_change(msg.client_number, "msg_stat_update", msg.id, msg)
+                msg_redirect_status_resp(msg, status)
+        
+        return unmatched
     
-
-    def handle_message_status_call(results: list[StandardMessageObject]):
-        for result in results:
-            if result.status:
-                msg = Message.query.filter_by(sid=result.message_id).first()
-                
-                if msg:
-                    msg.status = result.status.name
-                    db.session.commit()
-                    debug_log.debug("[WhatsApp API] Received status update and wrote update to database successfuly.")
-                
-                    from modules.messaging import message_status_change, msg_redirect_status_resp
-                    message_status_change(msg.client_number, "msg_stat_update", msg.id, msg)
-                    msg_redirect_status_resp(msg, result.status)
-                
-                else:
-                    debug_log.debug("[WhatsApp API] Received status update however the message which this status update is for does not exist!")
+    
+    def handle_message_receive(results: list[StandardMessageObject], check_all_sids: bool = False):
+        try:
+            return WhatsApp._persist_received_messages(results, check_all_sids)
         
-        return "OK", 200
+        except IntegrityError:
+            if check_all_sids:
+                raise
+            
+            # A duplicate older than the SID filter reached the unique index, retry with a full lookup
+            db.session.rollback()
+            sid_filter.record_index_fallback()
+            debug_log.debug("[WhatsApp API] Received a duplicate SID that was not in the SID filter. Retrying with a full SID lookup.")
+            return WhatsApp.handle_message_receive(results, True)
     
     
-    def handle_message_receive(results: list[StandardMessageObject]):
+    def _persist_received_messages(results: list[StandardMessageObject], check_all_sids: bool):
+        sids = {result.message_id for result in results}
+        
+        if not check_all_sids:
+            sids = {sid for sid in sids if sid_filter.might_contain(sid)}
+        
+        from_nums = {result.from_num_e164 for result in results}
+        existing_sids = {row.sid for row in db.session.query(Message.sid).filter(Message.sid.in_(sids)).all()} if sids else set()
+        sid_filter.record_duplicates(len(existing_sids))
+        
+        # Also the duplicates only the full lookup found, so that their next redelivery is caught by the filter
+        for sid in existing_sids:
+            sid_filter.add(sid)
+        
+        phone_numbers = {pn.number: pn for pn in PhoneNumber.query.filter(PhoneNumber.number.in_(from_nums)).all()} if from_nums else {}
+        new_msgs = []
+        unsupported_replies = []
+        
         for result in results:
             sid = result.message_id
             
-            if not Message.query.filter_by(sid=sid).first():
-                now = datetime.now()
-                from_num = result.from_num_e164
-                message = result.content
-                    
-                agents_resp = get_agents_responsible(from_num)
-                agents_resp_dict = {}
-                    
-                for id, agent in enumerate(agents_resp):
-                    agents_resp_dict.update({id: agent})
-                    
-                msg_type_name = result.type.name.lower()
-                    
-                if msg_type_name in ["document", "image", "audio", "voice", "video", "sticker"]:
-                    media_file = WhatsAppApiInterface.get_inbound_media(message.get("url"))
-                    
-                    if media_file:
-                        media_file_path = os.path.join(AppConfig.UPLOAD_FOLDER, "inbound_message_media")
-                        media_file_name = message.get("url").split("/")
-                        media_file_name.reverse()
-                        media_file_name = f"{media_file_name[0]}_{media_file_name[2]}.{media_file[1]}"
-                        
-                        if save_binary_file(media_file_path, media_file_name, media_file[0]):
-                            media_link = url_for("static", filename=f"{AppConfig.UPLOAD_FOLDER_STATIC_RELATIVE}/inbound_message_media/{media_file_name}", _external=True, _scheme=AppConfig.HTTP_SCHEME)
-                            
-                            if message.get("caption"):
-                                content = {"mediaUrl": media_link, "caption": message.get("caption")}
-                                
-                            else:
-                                content = {"mediaUrl": media_link}
-                                
-                            body_db = "Media File(s)"
-                            
-                        else:
-                            content = {"text": "System Error: Media Download Failure"}
-                            body_db = "System Error: Media Download Failure"
-                            result.type = MessageType.TEXT
-                        
-                    else:
-                        content = {"text": "System Error: Media Download Failure"}
-                        body_db = "System Error: Media Download Failure"
-                        result.type = MessageType.TEXT
-                    
-                elif msg_type_name == "text":
-                    body_db = message.get("text")
-                    content = {"text": message.get("text")}
-                    
-                elif msg_type_name == "location":
-                    body_db = "Location"
-                    content = {"longitude": message.get("longitude"), "latitude": message.get("latitude"), "name": message.get("name"), "address": message.get("address")}
-                    
-                else:
-                    WhatsAppApiInterface.send_freeform_message(StandardMessageObject(None, MessageType.CONTACT, {}, None, from_num, None, None))  # To send an error message (MEDIA_UNSUPPORTED)
-                    return "This is fine.", 200
+            if sid in existing_sids:
+                debug_log.debug("[WhatsApp API] Received message but the SID is not unique.")
+                continue
+            
+            existing_sids.add(sid)
+            now = datetime.now()
+            from_num = result.from_num_e164
+            message = result.content
                 
-                msg = Message(sid=sid, direction=0, client_number=from_num, agents_resp=agents_resp_dict, origin_phone_number=None, datetime=now, status=result.status, content=content, type=result.type.name, is_redirect=False)
-                agent = db.session.query(Agent).filter_by(phone_number=msg.client_number).first()
+            agents_resp = get_agents_responsible(from_num)
+            agents_resp_dict = {}
                 
-                pn_database = PhoneNumber.query.filter_by(number=msg.client_number).first()
-                    
-                if not pn_database:
-                    cid = generate_customer_id()
-                    pn_database = PhoneNumber(unread_msgs=1, last_msg=body_db, number=msg.client_number, customer_id=cid, display_name=cid)
-                    db.session.add(pn_database)
-                    
-                else:
-                    pn_database.unread_msgs = pn_database.unread_msgs + 1
-                    pn_database.last_msg = body_db
+            for id, agent in enumerate(agents_resp):
+                agents_resp_dict.update({id: agent})
                 
-                db.session.add(msg)
-                db.session.commit()
+            # Types MessageType does not know (e.g. interactive button and list replies) are unsupported
+            msg_type_name = result.type.name.lower() if result.type else None
                 
-                debug_log.debug("[WhatsApp API] Received message and wrote message to database successfuly.")
+            if msg_type_name in MEDIA_MESSAGE_TYPES:
+                content = pending_media_content(message)
+                body_db = "Media File(s)"
                 
-                msg = Message.query.filter_by(sid=sid).first()
-                from modules.messaging import message_status_change
-                message_status_change(msg.client_number, "msg_received", msg.id, msg)
+            elif msg_type_name == "text":
+                body_db = message.get("text")
+                content = {"text": message.get("text")}
+                
+            elif msg_type_name == "location":
+                body_db = "Location"
+                content = {"longitude": message.get("longitude"), "latitude": message.get("latitude"), "name": message.get("name"), "address": message.get("address")}
                 
             else:
-                debug_log.debug("[WhatsApp API] Received message but the SID is not unique.")
+                debug_log.debug(f"[WhatsApp API] Received a message of an unsupported type, replying with MEDIA_UNSUPPORTED. [{sid}]")
+                
+                # Queued once the received messages are committed, so a retried batch does not reply twice.
+                # Like the other system replies, it is sent through the outbox and recorded as an outgoing
+                # Message (its status callbacks need one), so it shows in the chat history. Outgoing
+                # messages do not change the unread count or the sidebar.
+                unsupported_replies.append(({"text": str(WA_SYSTEM_RESPONSES.MEDIA_UNSUPPORTED)}, MessageType.TEXT, from_num, False, None))
+                continue
+            
+            msg = Message(sid=sid, direction=0, client_number=from_num, agents_resp=agents_resp_dict, origin_phone_number=None, datetime=now, status=result.status, content=content, type=result.type.name, is_redirect=False)
+            pn_database = phone_numbers.get(from_num)
+                
+            if not pn_database:
+                cid = generate_customer_id()
+                pn_database = PhoneNumber(unread_msgs=1, last_msg=body_db, number=from_num, customer_id=cid, display_name=cid)
+                phone_numbers[from_num] = pn_database
+                db.session.add(pn_database)
+                unread_counter.record_new(1)
+                
+            else:
+                unread_counter.add(from_num, 1)
+                pn_database.last_msg = body_db
+            
+            db.session.add(msg)
+            new_msgs.append(msg)
+        
+        if new_msgs:
+            new_sids = {msg.sid for msg in new_msgs}
+            db.session.commit()
             
-        return "OK", 200
\ No newline at end of file
+            for sid in new_sids:
+                sid_filter.add(sid)
+            
+            debug_log.debug(f"[WhatsApp API] Received {len(new_msgs)} message(s) and wrote messages to database successfuly.")
+            
+            # Reloads every new message in one query after the commit expired them
+            Message.query.filter(Message.sid.in_(new_sids)).all()
+            
+            from modules.messaging import message_status_change
+            
+            for msg in new_msgs:
+                if msg.content.get("mediaPending"):
+                    media_downloader.submit(msg)
+                
+                message_status_change(msg.client_number, "msg_received", msg.id, msg)
+        
+        if unsupported_replies:
+            WhatsApp.send_freeform_messages(unsupported_replies)
+            
+        return "OK", 200
@@ -13,7 +13,8 @@ import requests
 from functools import wraps
 from init import waapi, log, debug_log, app
 from config import AppConfig
-from flask_security import verify_password
+from utils.callback_auth import callback_authenticator
+from utils.media_fetcher import media_fetcher
 from flask import Response, request, url_for
 from msg_dsp_text import WA_SYSTEM_RESPONSES
 from enum import Enum
@@ -31,21 +32,21 @@ ALWAYS_200_FAKE_CALLBACK = API_CALLBACK_PREFIX + "/fake_200_callback"
 
 
 # -=-=-= Functions =-=-=-
-def check_call_creds(username: str, password: str) -> bool:
-    if username == AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER and verify_password(password, AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS_HASH):
-        return True
-    
-    return False
+# ---- Builds a StandardMessageObject from a single result of a message status callback ----
+def status_result_to_message_obj(result: dict) -> "StandardMessageObject":
+    return StandardMessageObject(result.get("messageId"), None, None, None, f'+{result.get("to")}', MessageStatus.from_api_response(result.get("status")), None)
+
+
+# ---- Builds a StandardMessageObject from a single result of a message receive callback ----
+def receive_result_to_message_obj(result: dict) -> "StandardMessageObject":
+    return StandardMessageObject(result.get("messageId"), MessageType.from_str(result.get("message").get("type")), result.get("message"), f'+{result.get("from")}', f'+{result.get("to")}', "RECEIVED", None)
             
 
 # -=-=-= Decorators =-=-=-
 def authenticate_http_basic(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        username = request.args.get("user")
-        password = request.args.get("pass")
-        
-        if not (username and password) or not check_call_creds(username, password):
+        if not callback_authenticator.authenticate(request.args):
             debug_log.debug("[WhatsApp API Interface] Basic HTTP authentication for callback request failed. Responding with [WWW-Authenticate] header.")
             return Response("<h1>401 Unauthorized</h1>Please provide valid credentials.", 401, {"WWW-Authenticate": 'Basic realm="WaapiCallbacks"'})
         
@@ -139,19 +140,28 @@ class StandardMessageObject():
         self.callback_url = callback_url
 
 
+# -=-=-= Exceptions =-=-=-
+# ---- A message could not be sent, retryable is False if sending it again can not succeed (e.g. a 4xx response) ----
+class MessageSendError(Exception):
+    def __init__(self, message: str, retryable: bool):
+        super().__init__(message)
+        self.retryable = retryable
+
+
 # -=-=-= Main utility object =-=-=-
 class WhatsAppApiInterface():
-    def send_freeform_message(message_obj: StandardMessageObject) -> Union[StandardMessageObject, None]:
+    # ---- Sends a message, raises MessageSendError if it was not accepted by the API ----
+    def send_freeform_message(message_obj: StandardMessageObject) -> StandardMessageObject:
         try:
             callback_url = url_for("handle_message_status_call", _external=True, _scheme=AppConfig.HTTP_SCHEME)
-            callback_url = callback_url + f"?user={AppConfig.WAAPI_REQUEST_BASIC_AUTH_USER}&pass={AppConfig.WAAPI_REQUEST_BASIC_AUTH_PASS}"
+            callback_url = callback_url + callback_authenticator.callback_query_string()
             
-            msg_id = uuid.uuid4()
+            msg_id = message_obj.message_id or str(uuid.uuid4())
             
             message = {
                 "from": AppConfig.WAAPI_WHATSAPP_FROM_NUMBER.replace("+", ""),
                 "to": message_obj.to_num_e164.replace("+", ""),
-                "messageId": str(msg_id),
+                "messageId": msg_id,
                 "content": message_obj.content,
                 "callbackData": "",
                 "notifyUrl": callback_url
@@ -198,35 +208,33 @@ class WhatsAppApiInterface():
                 debug_log.debug(f"[WhatsApp API Interface] Unable to send CONTACT message as it is not supported by the system! [{message_obj.to_num_e164}]")
                 
             else:
-                raise Exception("Message type not supported!")
-                
-            return StandardMessageObject(response.message_id, message_obj.type, message_obj.content, AppConfig.WAAPI_WHATSAPP_FROM_NUMBER, message_obj.to_num_e164, MessageStatus.from_api_response(response.status.__dict__), callback_url)
+                raise MessageSendError("Message type not supported!", False)
             
+        except MessageSendError:
+            raise
+        
+        except requests.RequestException:
+            log.error(f"[WhatsApp API Interface] A connection error occured whilst trying to send a freeform WhatsApp message to [{message_obj.to_num_e164}]:", exc_info=1)
+            raise MessageSendError("Connection error", True)
+        
+        # Invalid message body, sending it again would fail the same way
         except Exception:
-            debug_log.debug(f"[WhatsApp API Interface] An exception occured whilst trying to send a freeform WhatsApp message to [{message_obj.to_num_e164}]:", exc_info=1)
             log.error(f"[WhatsApp API Interface] An exception occured whilst trying to send a freeform WhatsApp message to [{message_obj.to_num_e164}]:", exc_info=1)
-            return None
+            raise MessageSendError("Invalid message", False)
         
+        status_code = int(getattr(response, "status_code", 0) or 0)
         
-    def get_inbound_media(media_url: str) -> Union[tuple, None]:
-        media_url.replace("api.infobip.com", AppConfig.WAAPI_BASE_URL)
-        file = requests.get(media_url, headers={"Authorization": f"App {AppConfig.WAAPI_API_KEY}"})
-        
-        if file.status_code == 200:
-            if type(file.content) == bytes:
-                debug_log.debug(f"[WhatsApp API Interface] Successfully retrieved inbound media file. [{media_url}]")
-                return (file.content, file.headers.get("Content-Type").split("/")[1])
+        if status_code not in (200, 201) or not hasattr(response, "message_id"):
+            retryable = status_code == 0 or status_code == 429 or status_code >= 500
+            log.error(f"[WhatsApp API Interface] The API did not accept a freeform WhatsApp message to [{message_obj.to_num_e164}]. [HTTP {status_code}, retryable: {retryable}]")
+            raise MessageSendError(f"HTTP {status_code}", retryable)
             
-        elif file.status_code == 404:
-            debug_log.debug(f"[WhatsApp API Interface] Unable to retrieved inbound media file. (404 Not Found) [{media_url}]")
+        return StandardMessageObject(response.message_id, message_obj.type, message_obj.content, AppConfig.WAAPI_WHATSAPP_FROM_NUMBER, message_obj.to_num_e164, MessageStatus.from_api_response(response.status.__dict__), callback_url)
         
-        elif file.status_code == 429:
-            debug_log.debug(f"[WhatsApp API Interface] Unable to retrieved inbound media file. (429 Too Many Requests) [{media_url}]")
-            
-        else:
-            debug_log.debug(f"[WhatsApp API Interface] Unable to retrieved inbound media file. (Error {file.status_code}) [{media_url}]")
         
-        return None
+    def get_inbound_media(media_url: str) -> Union[tuple, None]:
+        media_url.replace("api.infobip.com", AppConfig.WAAPI_BASE_URL)
+        return media_fetcher.fetch(media_url)
     
     
     @app.route(MESSAGE_STATUS_CALLBACK, methods=["POST"])
@@ -234,13 +242,9 @@ class WhatsAppApiInterface():
     def handle_message_status_call():
         data = request.json
         debug_log.debug("[WhatsApp API Interface] Received status update.")
-        message_objs = []
         
-        for result in data.get("results"):
-            message_objs.append(StandardMessageObject(result.get("messageId"), None, None, None, f'+{result.get("to")}', MessageStatus.from_api_response(result.get("status")), None))
-        
-        from utils.whatsapp import WhatsApp
-        return WhatsApp.handle_message_status_call(message_objs)
+        from utils.inbound_queue import inbound_queue
+        return inbound_queue.ingest("msg_status", data.get("results"))
 
     
     @app.route(MESSAGE_RECEIVE_CALLBACK, methods=["POST"])
@@ -248,13 +252,9 @@ class WhatsAppApiInterface():
     def handle_message_receive():
         data = request.json
         debug_log.debug("[WhatsApp API Interface] Received message.")
-        message_objs = []
-        
-        for result in data.get("results"):
-            message_objs.append(StandardMessageObject(result.get("messageId"), MessageType.from_str(result.get("message").get("type")), result.get("message"), f'+{result.get("from")}', f'+{result.get("to")}', "RECEIVED", None))
         
-        from utils.whatsapp import WhatsApp
-        return WhatsApp.handle_message_receive(message_objs)
+        from utils.inbound_queue import inbound_queue
+        return inbound_queue.ingest("msg_receive", data.get("results"))
     
     
     @app.route(ALWAYS_200_FAKE_CALLBACK, methods=["POST", "GET"])
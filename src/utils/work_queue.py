@@ -0,0 +1,129 @@
+#  WhatsApp messaging client project
+#  Keyed background work queue utility
+
+
+# ------- Libraries and utils -------
+import time
+import queue
+import threading
+from collections import deque
+from typing import Callable, Union
+from init import app, socketio, log, debug_log
+
+
+# -=-=-= Main utility object =-=-=-
+# ---- Bounded worker pool that keeps items with the same key in FIFO order ----
+# Every key gets its own lane. A lane is only ever held by one worker at a time,
+# so items for the same key are handled in order while different keys run in parallel.
+# The handler is called as handler(key, items) inside an app context and may return
+# a delay in seconds to put the batch back at the front of its lane and retry it later.
+class KeyedWorkQueue():
+    def __init__(self, name: str, handler: Callable[[str, list], Union[float, None]], workers: int, max_batch_size: int = 1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.max_batch_size = max_batch_size
+
+        self._lanes = {}
+        self._inflight = {}
+        self._scheduled = set()
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+        self._processed = 0
+        self._failed = 0
+        self._retried = 0
+
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+
+            self._started = True
+
+        for i in range(self.workers):
+            socketio.start_background_task(self._worker)
+
+        debug_log.debug(f"[Work Queue] [{self.name}] Started {self.workers} worker(s).")
+
+
+    def submit(self, key: str, item, enqueued_at: Union[float, None] = None):
+        with self._lock:
+            self._lanes.setdefault(key, deque()).append((enqueued_at or time.time(), item))
+
+            if key in self._scheduled:
+                return
+
+            self._scheduled.add(key)
+
+        self._ready.put(key)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.time()
+            oldest = [lane[0][0] for lane in self._lanes.values() if lane] + list(self._inflight.values())
+
+            return {
+                "depth": sum(len(lane) for lane in self._lanes.values()),
+                "in_flight": len(self._inflight),
+                "active_keys": len(self._scheduled),
+                "lag_seconds": round(now - min(oldest), 3) if oldest else 0.0,
+                "processed": self._processed,
+                "failed": self._failed,
+                "retried": self._retried
+            }
+
+
+    def _requeue_later(self, key: str, delay: float):
+        socketio.sleep(delay)
+        self._ready.put(key)
+
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+
+            with self._lock:
+                lane = self._lanes[key]
+                batch = [lane.popleft() for i in range(min(len(lane), self.max_batch_size))]
+                self._inflight[key] = batch[0][0]
+
+            retry_delay = None
+            failed = False
+
+            try:
+                with app.app_context():
+                    retry_delay = self.handler(key, [item for enqueued_at, item in batch])
+
+            except Exception:
+                failed = True
+                log.error(f"[Work Queue] [{self.name}] An exception occured whilst handling a batch for [{key}]:", exc_info=1)
+
+            with self._lock:
+                self._inflight.pop(key, None)
+                lane = self._lanes[key]
+
+                if retry_delay is not None:
+                    lane.extendleft(reversed(batch))
+                    self._retried += len(batch)
+
+                else:
+                    if failed:
+                        self._failed += len(batch)
+
+                    else:
+                        self._processed += len(batch)
+
+                    if not lane:
+                        del self._lanes[key]
+                        self._scheduled.discard(key)
+                        continue
+
+            if retry_delay is not None:
+                socketio.start_background_task(self._requeue_later, key, retry_delay)
+
+            else:
+                self._ready.put(key)
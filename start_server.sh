@@ -1,2 +1,4 @@
 cd /home/serverpi/projects/wacsa/src
+flask --app app db upgrade
+flask --app app check-query-plans || exit 1
 gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 -b 127.0.0.1:5000 'app:create_app()'
\ No newline at end of file